@@ -0,0 +1,104 @@
+#!/usr/bin/python
+# --------------------------------------------------------------------------
+# combine.py
+#
+# Stress test of the combine and store/retrieve directives on a synthetic
+# directive with hundreds of repeated context siblings, and two para
+# elements holding as many value children.  Compares the quadratic
+# dd_combine that re-joined every sibling each time it fired against
+# Transformer's, which joins each group once.  Outputs are checked to match.
+#
+# usage: benchmarks/combine.py [SIBLINGS]
+# --------------------------------------------------------------------------
+
+from __future__ import print_function
+import sys
+from common import module, render, timeit, report
+from lxml import etree
+from rulesparser import RulesParser
+from doc2 import Transformer
+
+RULES = r'''
+[info]
+description = combine/store/retrieve stress test
+extension = txt
+directory = bench
+
+[defaults]
+~ ^
+    start:
+        sanitize = True
+    end:
+        sanitize = True
+
+[rules]
+~ /context(\[\d+\])?$
+    start:
+        combine = "context"
+        suffix = "\n"
+
+~ /value(\[\d+\])?$
+    start:
+        store = "values"
+
+~ /para(\[\d+\])?$
+    end:
+        retrieve = "values"
+        suffix = "\n"
+
+~ .*
+    start:
+        sanitize = True
+'''
+
+
+class OldTransformer (Transformer):
+    def dd_combine (self, t, elem=None, combine=None, debug=False, **_):
+        if combine:
+            t = ', '.join ([c.text for c in elem.getparent().findall (combine)])
+        return t
+
+    def dd_store (self, t, store=None, debug=False, **_):
+        if store:
+            self._store.setdefault (store, [])
+            self._store [store].append (t)
+            return None
+        return t
+
+    def dd_retrieve (self, t, retrieve=None, debug=False, **_):
+        if retrieve:
+            if retrieve in self._store:
+                t = ', '.join (self._store [retrieve])
+                del self._store [retrieve]
+        return t
+
+
+def children (siblings):
+    ''' a fill () for common.module () adding siblings context elements and
+        two para elements of as many values
+    '''
+    def fill (section, directive, n):
+        for m in range (siblings):
+            etree.SubElement (directive, 'context').text = 'context{0}'.format (m)
+        for p in range (2):
+            para = etree.SubElement (directive, 'para')
+            for m in range (siblings):
+                etree.SubElement (para, 'value').text = 'v{0}'.format (m)
+    return fill
+
+def main (siblings=500):
+    rules = RulesParser ()
+    rules.parse (RULES)
+    before, after = OldTransformer (rules), Transformer (rules)
+
+    print ("{0:<24} {1:>12} {2:>12} {3:>8}".format ('per directive', 'before', 'after', 'speedup'))
+    for n in max (siblings // 10, 1), siblings:
+        root = module (1, children (n)).find ('section/directive')
+        assert render (before, root) == render (after, root)
+        report ('{0} siblings'.format (n),
+            timeit (lambda: render (before, root), repeat=3, number=1),
+            timeit (lambda: render (after, root), repeat=3, number=1)
+        )
+
+if __name__ == '__main__':
+    main (*[int (a) for a in sys.argv [1:]])
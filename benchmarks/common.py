@@ -0,0 +1,86 @@
+# --------------------------------------------------------------------------
+# common.py
+#
+# Helpers shared by the doc2.py benchmarks.
+#
+# --------------------------------------------------------------------------
+
+from __future__ import print_function
+import os, sys
+import time
+
+BASE_DIR = os.path.dirname (os.path.dirname (os.path.abspath (__file__)))
+SAMPLE = os.path.join (BASE_DIR, 'samples', 'ngx_http_image_filter_module.xml')
+FORMATS = ['rst', 'mediawiki', 'nginx-wiki']
+
+sys.path.insert (0, BASE_DIR)
+
+from lxml import etree
+from rulesparser import RulesParser
+from doc2 import walk, pruner
+
+
+def load_rules (format):
+    rules = RulesParser ()
+    rules.parse (file (os.path.join (BASE_DIR, '%s.rules' % format)))
+    return rules
+
+def load_tree (filename=SAMPLE):
+    ''' parse without DTD validation, the nginx DTDs aren't shipped with doc2
+    '''
+    return etree.parse (filename, etree.XMLParser (dtd_validation=False))
+
+def directives (tree, root_element='//directive'):
+    return tree.xpath (root_element)
+
+def xpaths (tree, root_element='//directive'):
+    ''' the XPaths doc2.py searches the rules with, in walk order
+    '''
+    paths = []
+    for directive in directives (tree, root_element):
+        root = etree.ElementTree (directive)
+        for event, elem in etree.iterwalk (directive, events=('start', 'end')):
+            paths.append (root.getpath (elem))
+    return paths
+
+def module (directives, fill):
+    ''' a synthetic <module><section> of directives named d0, d1, ...
+        fill (section, directive, n) adds each one's content, and may add
+        elements to the section after it
+    '''
+    root = etree.Element ('module', name='bench')
+    section = etree.SubElement (root, 'section')
+    for n in range (directives):
+        fill (section, etree.SubElement (section, 'directive', name='d{0}'.format (n)), n)
+    return root
+
+def render (processor, root):
+    ''' the text a Transformer renders root to, walked (and pruned) as
+        doc2.convert_element () walks a root element
+    '''
+    processor.set_srcfile ('bench.xml')
+    processor.set_root (root)
+    output = []
+    for event, elem, xpath in walk (root, pruner ([processor])):
+        t = processor.process_element (event, elem, xpath)
+        if t is not None:
+            output.append (t)
+    return ''.join (output)
+
+def timeit (func, repeat=5, number=100):
+    ''' best of repeat runs of number calls, in seconds per call
+    '''
+    best = None
+    for r in range (repeat):
+        start = time.time ()
+        for n in range (number):
+            func ()
+        elapsed = (time.time () - start) / number
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def report (label, before, after, count=1):
+    print ("{0:<24} {1:>10.2f}us {2:>10.2f}us {3:>7.2f}x".format (
+        label, before * 1e6 / count, after * 1e6 / count, before / after if after else 0
+    ))
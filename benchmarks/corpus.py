@@ -0,0 +1,261 @@
+#!/usr/bin/python
+# --------------------------------------------------------------------------
+# corpus.py
+#
+# Generates a synthetic corpus of nginx module documentation: module XML
+# files shaped like the nginx.org sources (summary and example sections,
+# directives with syntax, default, context and paragraphs holding inline
+# markup, nested lists and examples), and the module.dtd they validate
+# against.  Sizes are configurable and the output only depends on the
+# settings and the seed.
+#
+# usage: benchmarks/corpus.py [options] DIR
+#
+# The corpus can be converted with doc2.py itself: doc2.py -s DIR/ -f rst
+# --------------------------------------------------------------------------
+
+from __future__ import print_function
+import os
+import random
+from optparse import OptionParser
+from lxml import etree
+
+DTD = '''<!ENTITY % inline "literal | value | var | emphasis | link | http-status | command | path | header | c-def | c-func">
+<!ENTITY % block "list | example | note">
+
+<!ELEMENT module (section+)>
+<!ATTLIST module
+  name CDATA #REQUIRED
+  link CDATA #IMPLIED
+  lang CDATA #IMPLIED>
+
+<!ELEMENT section (para | directive)*>
+<!ATTLIST section
+  id CDATA #REQUIRED
+  name CDATA #IMPLIED>
+
+<!ELEMENT directive (syntax+, default, context+, appeared-in?, para+)>
+<!ATTLIST directive
+  name CDATA #REQUIRED>
+
+<!ELEMENT syntax (#PCDATA | literal | value)*>
+<!ELEMENT default (#PCDATA | literal | value)*>
+<!ELEMENT context (#PCDATA)>
+<!ELEMENT appeared-in (#PCDATA)>
+
+<!ELEMENT para (#PCDATA | %inline; | %block;)*>
+<!ELEMENT note (#PCDATA | %inline;)*>
+<!ELEMENT example (#PCDATA)>
+
+<!ELEMENT list (listitem+ | (tag-name, tag-desc)+)>
+<!ATTLIST list
+  type (bullet | enum | tag) "bullet">
+<!ELEMENT listitem (#PCDATA | %inline; | %block;)*>
+<!ELEMENT tag-name (#PCDATA | literal | value)*>
+<!ELEMENT tag-desc (#PCDATA | %inline; | %block;)*>
+
+<!ELEMENT literal (#PCDATA)>
+<!ELEMENT value (#PCDATA)>
+<!ELEMENT var (#PCDATA)>
+<!ELEMENT emphasis (#PCDATA)>
+<!ELEMENT command (#PCDATA)>
+<!ELEMENT path (#PCDATA)>
+<!ELEMENT header (#PCDATA)>
+<!ELEMENT c-def (#PCDATA)>
+<!ELEMENT c-func (#PCDATA)>
+<!ELEMENT link (#PCDATA | literal)*>
+<!ATTLIST link
+  url CDATA #IMPLIED
+  id CDATA #IMPLIED>
+<!ELEMENT http-status EMPTY>
+<!ATTLIST http-status
+  code CDATA #REQUIRED
+  text CDATA #REQUIRED>
+'''
+
+DOCTYPE = '<!DOCTYPE module SYSTEM "module.dtd">'
+
+WORDS = '''the module sets size of buffer used for reading response from proxied server
+request headers client body connection timeout value can contain variables
+this directive is enabled by default when it appears in location block and
+specifies maximum number of requests which may be processed at once'''.split ()
+
+INLINE = ['literal', 'value', 'var', 'emphasis', 'path', 'header', 'command']
+
+CONTEXTS = ['http', 'server', 'location', 'if in location', 'upstream']
+
+STATUSES = [('400', 'Bad Request'), ('403', 'Forbidden'), ('415', 'Unsupported Media Type'), ('503', 'Service Unavailable')]
+
+
+class Generator (object):
+    ''' builds module trees; depth is how deeply lists nest in a directive's
+        paragraphs, siblings the number of paragraphs per directive and items
+        per list, example_lines the length of examples
+    '''
+    def __init__ (self, directives=20, depth=2, siblings=3, example_lines=8, seed=1):
+        self.directives = directives
+        self.depth = depth
+        self.siblings = siblings
+        self.example_lines = example_lines
+        self.random = random.Random (seed)
+
+    def words (self, n):
+        return ' '.join (self.random.choice (WORDS) for i in range (n))
+
+    def text (self, parent, words=12):
+        ''' a sentence with inline markup, appended to parent's content
+        '''
+        last = parent [-1] if len (parent) else None
+        sentence = '\n' + self.words (self.random.randint (words // 2, words)) + ' '
+        if last is None:
+            parent.text = (parent.text or '') + sentence
+        else:
+            last.tail = (last.tail or '') + sentence
+
+        for i in range (self.random.randint (1, 3)):
+            kind = self.random.choice (INLINE + ['link', 'http-status'])
+            if kind == 'link':
+                elem = etree.SubElement (parent, 'link', url='#' + self.random.choice (WORDS))
+                elem.text = self.words (2)
+            elif kind == 'http-status':
+                code, text = self.random.choice (STATUSES)
+                elem = etree.SubElement (parent, 'http-status', code=code, text=text)
+            else:
+                elem = etree.SubElement (parent, kind)
+                elem.text = self.random.choice (WORDS)
+            elem.tail = ' ' + self.words (self.random.randint (2, 6))
+        parent [-1].tail += '.\n'
+
+    def example (self, parent):
+        lines = ['{0} {1};'.format (self.random.choice (WORDS), self.words (2)) for i in range (self.example_lines)]
+        example = etree.SubElement (parent, 'example')
+        example.text = '\nlocation /{0}/ {{\n    {1}\n}}\n'.format (self.random.choice (WORDS), '\n    '.join (lines))
+        example.tail = '\n'
+
+    def list (self, parent, depth):
+        kind = 'tag' if depth % 2 else 'bullet'
+        elem = etree.SubElement (parent, 'list', type=kind)
+        elem.text = '\n'
+        for i in range (self.siblings):
+            if kind == 'tag':
+                name = etree.SubElement (elem, 'tag-name')
+                etree.SubElement (name, 'literal').text = self.random.choice (WORDS)
+                name.tail = '\n'
+                item = etree.SubElement (elem, 'tag-desc')
+            else:
+                item = etree.SubElement (elem, 'listitem')
+            self.text (item)
+            if depth > 1:
+                self.list (item, depth - 1)
+            elif i == 0 and self.example_lines:
+                self.example (item)
+            item.tail = '\n'
+        elem.tail = '\n'
+
+    def directive (self, section, name, index):
+        directive = etree.SubElement (section, 'directive', name=name)
+        directive.text = '\n'
+        for i in range (self.random.randint (1, 2)):
+            syntax = etree.SubElement (directive, 'syntax')
+            values = [self.random.choice (WORDS) for n in range (self.random.randint (1, 3))]
+            for n, value in enumerate (values):
+                elem = etree.SubElement (syntax, 'value' if n % 2 else 'literal')
+                elem.text = value
+                elem.tail = ' | ' if n < len (values) - 1 else ''
+            syntax.tail = '\n'
+        default = etree.SubElement (directive, 'default')
+        default.text = self.random.choice (['', 'off', '1m', '60s'])
+        default.tail = '\n'
+        for context in CONTEXTS [:self.random.randint (1, 3)]:
+            etree.SubElement (directive, 'context').text = context
+            directive [-1].tail = '\n'
+        if index % 3 == 0:
+            etree.SubElement (directive, 'appeared-in').text = '1.{0}.{1}'.format (index % 10, index)
+            directive [-1].tail = '\n'
+
+        for i in range (self.siblings):
+            para = etree.SubElement (directive, 'para')
+            self.text (para)
+            if i == 0 and self.depth:
+                self.list (para, self.depth)
+            elif i == 1 and self.example_lines:
+                self.example (para)
+            para.tail = '\n\n'
+        directive.tail = '\n\n'
+
+    def module (self, n):
+        name = 'ngx_http_bench{0}_module'.format (n)
+        root = etree.Element ('module', name='Module ' + name, link='/en/docs/http/{0}.html'.format (name), lang='en')
+        root.text = '\n\n'
+
+        summary = etree.SubElement (root, 'section', id='summary')
+        summary.text = '\n'
+        for i in range (self.siblings):
+            self.text (etree.SubElement (summary, 'para'))
+            summary [-1].tail = '\n'
+
+        example = etree.SubElement (root, 'section', id='example', name='Example Configuration')
+        example.text = '\n'
+        para = etree.SubElement (example, 'para')
+        if self.example_lines:
+            self.example (para)
+        else:
+            self.text (para)
+
+        section = etree.SubElement (root, 'section', id='directives', name='Directives')
+        section.text = '\n\n'
+        for i in range (self.directives):
+            self.directive (section, 'bench{0}_directive_{1}'.format (n, i), i)
+        for s in summary, example, section:
+            s.tail = '\n\n'
+        return etree.ElementTree (root)
+
+def generate (directory, modules=10, **settings):
+    ''' write modules module files and module.dtd to directory, returning
+        the files' names
+    '''
+    if not os.path.isdir (directory):
+        os.makedirs (directory)
+    with open (os.path.join (directory, 'module.dtd'), 'w') as f:
+        f.write (DTD)
+
+    generator = Generator (**settings)
+    dtd = etree.DTD (os.path.join (directory, 'module.dtd'))
+    filenames = []
+    for n in range (modules):
+        tree = generator.module (n)
+        assert dtd.validate (tree), dtd.error_log.filter_from_errors ()
+        filename = os.path.join (directory, 'ngx_http_bench{0}_module.xml'.format (n))
+        with open (filename, 'wb') as f:
+            f.write (etree.tostring (tree, encoding='utf-8', xml_declaration=True, doctype=DOCTYPE))
+            f.write ('\n')
+        filenames.append (filename)
+    return filenames
+
+def corpus_options (parser):
+    ''' the generator's settings, also used by suite.py
+    '''
+    parser.set_defaults (modules=10, directives=20, depth=2, siblings=3, example_lines=8, seed=1)
+    parser.add_option ("--modules", dest="modules", help="module files to generate [10]", metavar="N", type=int)
+    parser.add_option ("--directives", dest="directives", help="directives per module [20]", metavar="N", type=int)
+    parser.add_option ("--depth", dest="depth", help="nesting depth of lists in a directive, 0 for none [2]", metavar="N", type=int)
+    parser.add_option ("--siblings", dest="siblings", help="paragraphs per directive and items per list [3]", metavar="N", type=int)
+    parser.add_option ("--example-lines", dest="example_lines", help="lines per example, 0 for no examples [8]", metavar="N", type=int)
+    parser.add_option ("--seed", dest="seed", help="random seed [1]", metavar="N", type=int)
+
+def settings (options):
+    return dict ((k, getattr (options, k)) for k in ('directives', 'depth', 'siblings', 'example_lines', 'seed'))
+
+def main ():
+    parser = OptionParser (usage="%prog [options] DIR")
+    corpus_options (parser)
+    (options, args) = parser.parse_args ()
+    if len (args) != 1:
+        parser.error ("a directory to generate the corpus in is required")
+    filenames = generate (args [0], options.modules, **settings (options))
+    print ("{0} modules, {1} elements in {2}".format (
+        len (filenames), sum (sum (1 for e in etree.parse (f).iter ()) for f in filenames), args [0]
+    ))
+
+if __name__ == '__main__':
+    main ()
@@ -0,0 +1,57 @@
+#!/usr/bin/python
+# --------------------------------------------------------------------------
+# memo.py
+#
+# Renders a synthetic module whose directives repeat the same boilerplate
+# paragraphs, lists and examples with each format's rules, with and without
+# Transformer.memoize ().  Outputs are checked to match and the memo's hits,
+# misses and uncacheable subtrees shown.
+#
+# usage: benchmarks/memo.py [DIRECTIVES]
+# --------------------------------------------------------------------------
+
+from __future__ import print_function
+import sys
+from common import FORMATS, load_rules, module, render, timeit, report
+from lxml import etree
+from doc2 import Transformer
+
+
+def fill (section, directive, n):
+    syntax = etree.SubElement (directive, 'syntax')
+    syntax.text = 'd{0} '.format (n)
+    etree.SubElement (syntax, 'value').text = 'size'
+    etree.SubElement (directive, 'default').text = 'd{0} 1k'.format (n)
+    etree.SubElement (directive, 'context').text = 'http'
+    for m in range (3):
+        para = etree.SubElement (directive, 'para')
+        para.text = 'Sets the size of the buffer used for reading the response, see '
+        link = etree.SubElement (para, 'link', url='#buffers')
+        link.text = 'buffers'
+        link.tail = ' for the details, which apply to every directive of the module. '
+    items = etree.SubElement (directive, 'list', type='bullet')
+    for m in range (4):
+        item = etree.SubElement (items, 'listitem')
+        item.text = 'the value is rounded up to a multiple of the page size'
+    example = etree.SubElement (directive, 'example')
+    example.text = '\nlocation / {\n    buffer_size 4k;\n}\n'
+
+def render_all (processor, root):
+    return ''.join (render (processor, directive) for directive in root.iter ('directive'))
+
+def main (directives=200):
+    print ("{0:<24} {1:>12} {2:>12} {3:>8}".format ('per module', 'before', 'after', 'speedup'))
+    root = module (directives, fill)
+    for format in FORMATS:
+        rules = load_rules (format)
+        before, after = Transformer (rules), Transformer (rules)
+        after.memoize ()
+        assert render_all (before, root) == render_all (after, root)
+        report ('{0}, {1} directives'.format (format, directives),
+            timeit (lambda: render_all (before, root), repeat=3, number=5),
+            timeit (lambda: render_all (after, root), repeat=3, number=5)
+        )
+        print ("{0:<24} {hits} hits, {misses} misses, {uncacheable} uncacheable".format ('', **after.memo_stats))
+
+if __name__ == '__main__':
+    main (*[int (a) for a in sys.argv [1:]])
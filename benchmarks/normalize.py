@@ -0,0 +1,59 @@
+#!/usr/bin/python
+# --------------------------------------------------------------------------
+# normalize.py
+#
+# Measures the sanitize and collapse directives on every text and tail of
+# the sample (or the given XML files), plus synthetic strings full of
+# non-ascii punctuation.  Compares the chain of re.sub () calls the
+# directives used to run per string against doc2.Normalizer, which scans
+# once for anything to sanitize and uses regexes compiled up front.
+# Outputs are checked to match.
+#
+# usage: benchmarks/normalize.py [XML ...]
+# --------------------------------------------------------------------------
+
+from __future__ import print_function
+import re, sys
+from common import SAMPLE, timeit, report, load_tree
+from doc2 import Normalizer
+
+
+def old_sanitize (t):
+    t = re.sub (ur'\xa0', ' ', t)
+    t = re.sub (ur'[\u201c\u201d]', '"', t)
+    t = re.sub (ur'\u2019', "'", t)
+    t = re.sub (ur'[\u2014\u2018]', '-', t)
+    return t
+
+def old_collapse (t):
+    return re.sub (ur'\s+', ' ', t)
+
+def texts (filenames):
+    strings = []
+    for filename in filenames:
+        for elem in load_tree (filename).iter ():
+            strings.extend (t for t in (elem.text, elem.tail) if t)
+    return strings
+
+def synthetic (count=200):
+    t = u'\u201cquoted\u201d it\u2019s\xa0a \u2018dash\u2014\n\t  and   spaces '
+    return [t * (n % 8 + 1) for n in range (count)]
+
+def main (*filenames):
+    normalizer = Normalizer ()
+    before = lambda strings: [old_collapse (old_sanitize (t)) for t in strings]
+    after = lambda strings: [normalizer.collapse (normalizer.sanitize (t)) for t in strings]
+
+    print ("{0:<24} {1:>12} {2:>12} {3:>8}".format ('per string', 'before', 'after', 'speedup'))
+    for label, strings in ('sample texts', texts (filenames or [SAMPLE])), ('synthetic', synthetic ()):
+        result = before (strings)
+        assert result == after (strings)
+        assert [type (t) for t in result] == [type (t) for t in after (strings)]
+        report (label,
+            timeit (lambda: before (strings), number=20),
+            timeit (lambda: after (strings), number=20),
+            len (strings)
+        )
+
+if __name__ == '__main__':
+    main (*sys.argv [1:])
@@ -0,0 +1,62 @@
+#!/usr/bin/python
+# --------------------------------------------------------------------------
+# pipeline.py
+#
+# Per-element cost of resolving which directives a rule applies: the
+# RulesParser.settings () + getattr () loop Transformer.process_element
+# used to run for every event, versus the pipelines Transformer builds
+# once per (rule, event).  The full process_element time is shown for
+# scale.
+#
+# usage: benchmarks/pipeline.py [XML ...]
+# --------------------------------------------------------------------------
+
+from __future__ import print_function
+import sys
+from common import FORMATS, SAMPLE, load_rules, load_tree, directives, timeit, report
+from lxml import etree
+from doc2 import Transformer
+
+
+def settings_lookup (processor, rules, match, event):
+    methods = []
+    for directive in rules.settings (match, event):
+        if directive in processor.directives:
+            methods.append (getattr (processor, "dd_{0}".format (directive)))
+    return methods
+
+def main (sources):
+    trees = [load_tree (source) for source in sources]
+    print ("{0:<24} {1:>12} {2:>12} {3:>8}".format ('per element', 'before', 'after', 'speedup'))
+
+    for format in FORMATS:
+        rules = load_rules (format)
+        processor = Transformer (rules)
+        processor.set_srcfile ('bench.xml')
+
+        events = []
+        for tree in trees:
+            for directive in directives (tree):
+                root = etree.ElementTree (directive)
+                for event, elem in etree.iterwalk (directive, events=('start', 'end')):
+                    match, mo = rules.search (root.getpath (elem))
+                    if match is not None:
+                        events.append ((match, event))
+
+        for match, event in events:
+            assert settings_lookup (processor, rules, match, event) == list (processor._pipelines [match, event])
+
+        before = timeit (lambda: [settings_lookup (processor, rules, m, e) for m, e in events])
+        after = timeit (lambda: [processor._pipelines [m, e] for m, e in events])
+        report ('%s' % format, before, after, len (events))
+
+        def walk ():
+            for tree in trees:
+                for directive in directives (tree):
+                    processor.set_root (directive)
+                    for event, elem in etree.iterwalk (directive, events=('start', 'end')):
+                        processor.process_element (event, elem)
+        print ("{0:<24} {1:>10.2f}us".format ('  process_element', timeit (walk, number=20) * 1e6 / len (events)))
+
+if __name__ == '__main__':
+    main (sys.argv [1:] or [SAMPLE])
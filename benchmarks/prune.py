@@ -0,0 +1,88 @@
+#!/usr/bin/python
+# --------------------------------------------------------------------------
+# prune.py
+#
+# Walks a synthetic module whose sections hold large discarded blocks next
+# to a few directives, with the same rules with and without prune = True on
+# the discarded blocks.  Without it every descendant is still looked up,
+# evaluated and discarded; with it walk () skips them.  Outputs are checked
+# to match and the skipped elements counted.
+#
+# usage: benchmarks/prune.py [PARAS]
+# --------------------------------------------------------------------------
+
+from __future__ import print_function
+import sys
+from common import module, render, timeit, report
+from lxml import etree
+from rulesparser import RulesParser
+import doc2
+from doc2 import Transformer
+
+RULES = r'''
+[info]
+description = prune benchmark
+extension = txt
+directory = bench
+
+[defaults]
+~ ^
+    start:
+        sanitize = True
+    end:
+        sanitize = True
+
+[rules]
+~ /para(\[\d+\])?$
+    start:
+        discard = True
+        prune = {0}
+    end:
+        discard = True
+
+~ /para(\[\d+\])?/
+    start:
+        discard = True
+    end:
+        discard = True
+
+~ .*
+    start:
+        sanitize = True
+'''
+
+
+def fill (section, directive, n):
+    directive.text = 'directive {0}'.format (n)
+    para = etree.SubElement (section, 'para')
+    para.text = 'para {0} '.format (n)
+    for m in range (5):
+        link = etree.SubElement (para, 'link', url='u{0}'.format (m))
+        etree.SubElement (link, 'code').text = 'code'
+        link.tail = ' and '
+
+def transformer (prune):
+    rules = RulesParser ()
+    rules.parse (RULES.replace ('{0}', prune))
+    return Transformer (rules)
+
+def main (paras=200):
+    before, after = transformer ('False'), transformer ('True')
+
+    print ("{0:<24} {1:>12} {2:>12} {3:>8}".format ('per module', 'before', 'after', 'speedup'))
+    for n in max (paras // 10, 1), paras:
+        root = module (n, fill)
+        assert render (before, root) == render (after, root)
+        doc2.walk_stats.update (pruned=0)
+        render (after, root)
+        paras = root.findall ('section/para')
+        assert doc2.walk_stats ['pruned'] == len (paras)
+        skipped = sum (1 for para in paras for e in para.iterdescendants ())
+        report ('{0} paras'.format (n),
+            timeit (lambda: render (before, root), repeat=3, number=5),
+            timeit (lambda: render (after, root), repeat=3, number=5)
+        )
+        print ("{0:<24} {1} of {2} elements skipped".format ('', skipped, sum (1 for e in root.iter ())))
+
+if __name__ == '__main__':
+    main (*[int (a) for a in sys.argv [1:]])
@@ -0,0 +1,72 @@
+#!/usr/bin/python
+# --------------------------------------------------------------------------
+# rulecode.py
+#
+# Per-element cost of evaluating rule code blocks: building the namespace
+# dict and exec'ing the block's code object on every event, as
+# Transformer.process_element used to, versus Transformer.evaluate, which
+# uses the settings of constant blocks directly and runs the rest as
+# functions.  The settings the directives receive are checked to match.
+#
+# usage: benchmarks/rulecode.py [XML ...]
+# --------------------------------------------------------------------------
+
+from __future__ import print_function
+import os, sys
+import re, string
+from common import FORMATS, SAMPLE, load_rules, load_tree, directives, timeit, report
+from lxml import etree
+from doc2 import Transformer
+
+
+def exec_block (processor, rules, match, mo, event, elem, xpath):
+    vars = {
+        're': re,
+        'string': string,
+        'os': os,
+        'event': event,
+        'elem': elem,
+        'last_output': processor.last_output,
+        'match': mo,
+        'regex': match,
+        'xpath': xpath,
+        'filename': 'bench',
+        'globals': processor._globals
+    }
+    exec (rules.obj (match, event), processor._globals, vars)
+    return vars
+
+def main (sources):
+    trees = [load_tree (source) for source in sources]
+    print ("{0:<24} {1:>12} {2:>12} {3:>8}".format ('per element', 'exec', 'evaluate', 'speedup'))
+
+    for format in FORMATS:
+        rules = load_rules (format)
+        processor = Transformer (rules)
+        processor.set_srcfile ('bench.xml')
+
+        events = []
+        for tree in trees:
+            for directive in directives (tree):
+                root = etree.ElementTree (directive)
+                for event, elem in etree.iterwalk (directive, events=('start', 'end')):
+                    xpath = root.getpath (elem)
+                    match, mo = rules.search (xpath)
+                    if match is not None:
+                        events.append ((match, mo, event, elem, xpath))
+
+        static = 0
+        for match, mo, event, elem, xpath in events:
+            before = exec_block (processor, rules, match, mo, event, elem, xpath)
+            after = processor.evaluate (match, mo, event, elem, xpath)
+            for name in rules.directives (match, event):
+                assert before [name] == after [name], (match, event, name)
+            static += rules.block (match, event)[0] is not None
+
+        before = timeit (lambda: [exec_block (processor, rules, *e) for e in events], number=20)
+        after = timeit (lambda: [processor.evaluate (*e) for e in events], number=20)
+        report (format, before, after, len (events))
+        print ("{0:<24} {1} of {2} events from constant blocks".format ('', static, len (events)))
+
+if __name__ == '__main__':
+    main (sys.argv [1:] or [SAMPLE])
@@ -0,0 +1,42 @@
+#!/usr/bin/python
+# --------------------------------------------------------------------------
+# search.py
+#
+# Compare RulesParser rule lookup against the linear scan over every
+# [rules] regex it replaced, both through the dispatch index alone and
+# through the XPath cache.  Times are per XPath lookup.
+#
+# usage: benchmarks/search.py [XML ...]
+# --------------------------------------------------------------------------
+
+from __future__ import print_function
+import sys
+import re
+from common import FORMATS, SAMPLE, load_rules, load_tree, xpaths, timeit, report
+
+
+def linear_search (rules, pattern):
+    for regex in rules.rules ():
+        mo = rules.get ('rules')[regex]['.re'].search (pattern, re.M)
+        if mo: return regex, mo
+    return None, None
+
+def main (sources):
+    paths = []
+    for source in sources:
+        paths.extend (xpaths (load_tree (source)))
+
+    print ("{0} XPaths from {1} file(s)\n".format (len (paths), len (sources)))
+    print ("{0:<24} {1:>12} {2:>12} {3:>8}".format ('rules', 'linear', 'after', 'speedup'))
+    for format in FORMATS:
+        rules = load_rules (format)
+        for p in paths:
+            assert linear_search (rules, p)[0] == rules.lookup (p)[0] == rules.search (p)[0], p
+
+        before = timeit (lambda: [linear_search (rules, p) for p in paths])
+        report ('%s (dispatch)' % format, before, timeit (lambda: [rules.lookup (p) for p in paths]), len (paths))
+        report ('%s (cached)' % format, before, timeit (lambda: [rules.search (p) for p in paths]), len (paths))
+        print ("{0:<24} {1} hits, {2} misses".format ('', rules.cache.hits, rules.cache.misses))
+
+if __name__ == '__main__':
+    main (sys.argv [1:] or [SAMPLE])
@@ -0,0 +1,53 @@
+#!/usr/bin/python
+# --------------------------------------------------------------------------
+# startup.py
+#
+# Startup cost of doc2.py: a fresh interpreter importing doc2 and loading
+# a rules file.  Cold runs parse the rules with pyparsing and compile every
+# code block (writing the cache), warm runs load the compiled rules from
+# the cache and never import pyparsing.  Timings include interpreter start.
+#
+# usage: benchmarks/startup.py [FORMAT ...]
+# --------------------------------------------------------------------------
+
+from __future__ import print_function
+import os, sys
+import subprocess
+import tempfile
+import time
+from common import BASE_DIR, FORMATS
+
+SCRIPT = r'''
+import sys, doc2
+from rulesparser import RulesParser
+rules = RulesParser ()
+rules.load (sys.argv [1], sys.argv [2])
+assert rules.cached == (sys.argv [3] == 'warm')
+assert ('pyparsing' in sys.modules) != rules.cached
+'''
+
+
+def run (format, cache, mode):
+    start = time.time ()
+    subprocess.check_call (
+        [sys.executable, '-c', SCRIPT, '%s.rules' % format, cache, mode], cwd=BASE_DIR
+    )
+    return time.time () - start
+
+def main (*formats):
+    cache = os.path.join (tempfile.mkdtemp (), 'rules.cache')
+    print ("{0:<24} {1:>12} {2:>12} {3:>8}".format ('per process', 'cold', 'warm', 'speedup'))
+    for format in formats or FORMATS:
+        cold, warm = [], []
+        for n in range (5):
+            if os.path.exists (cache):
+                os.remove (cache)
+            cold.append (run (format, cache, 'cold'))
+            warm.append (run (format, cache, 'warm'))
+        cold, warm = min (cold), min (warm)
+        print ("{0:<24} {1:>10.1f}ms {2:>10.1f}ms {3:>7.2f}x".format (format, cold * 1e3, warm * 1e3, cold / warm))
+    os.remove (cache)
+    os.rmdir (os.path.dirname (cache))
+
+if __name__ == '__main__':
+    main (*sys.argv [1:])
@@ -0,0 +1,160 @@
+#!/usr/bin/python
+# --------------------------------------------------------------------------
+# suite.py
+#
+# Throughput of the whole doc2.py pipeline on a synthetic corpus (see
+# corpus.py), for each shipped rules file.  Every format runs in its own
+# process so its peak memory can be measured; the corpus is converted
+# REPEAT times and the fastest run reported, split into phases:
+#
+#   parse     parsing the sources (loading their DTD)
+#   validate  validating them against the DTD, loaded once
+#   walk      walking the root elements through the Transformer
+#   write     writing the fragments to a fresh directory
+#
+# along with elements (below the root elements) per second over all
+# phases and the process's peak RSS.  --json writes the results for
+# comparing runs with --compare.
+#
+# usage: benchmarks/suite.py [options] [FORMAT ...]
+# --------------------------------------------------------------------------
+
+from __future__ import print_function
+import os, sys
+import json
+import resource
+import shutil
+import subprocess
+import tempfile
+from glob import glob
+from optparse import OptionParser, SUPPRESS_HELP
+from common import BASE_DIR, FORMATS
+from corpus import corpus_options, generate, settings
+import doc2
+from doc2 import OrderedDict, convert, load, option_parser
+from validation import Validator
+from profiler import clock
+
+PHASES = ['parse', 'validate', 'walk', 'write']
+
+
+def run (format, directory, repeat):
+    ''' convert the corpus in directory with a format's rules, in this
+        process, returning the fastest run's results
+    '''
+    options = option_parser ().get_default_values ()
+    options.formats = [format]
+    options.rules_dir = BASE_DIR
+    options.src_dir = directory
+    options.dest_dir = tempfile.mkdtemp ()
+    processors, _ = load (options)
+    sources = sorted (os.path.basename (f) for f in glob (os.path.join (directory, '*.xml')))
+
+    best = None
+    try:
+        for r in range (repeat):
+            shutil.rmtree (options.dest_dir)
+            doc2.made_dirs.clear ()
+            validator = Validator (cache_dtd=True)
+            result = dict ((phase, 0.0) for phase in PHASES)
+            result.update (elements=0, fragments=0)
+            for filename in sources:
+                tree = validator.parse (os.path.join (directory, filename))
+                result ['elements'] += sum (
+                    sum (1 for e in root.iter ()) for root in tree.xpath (options.root_element)
+                )
+
+                pending = []
+                def collect (*args):
+                    pending.append (args)
+                    return args [4].get (options.fname_attribute)
+                start = clock ()
+                convert (processors, validator, options, directory, filename, tree=tree, write=collect)
+                result ['walk'] += clock () - start
+
+                start = clock ()
+                for args in pending:
+                    doc2.write_fragment (*args)
+                result ['write'] += clock () - start
+                result ['fragments'] += len (pending)
+
+            result ['parse'] = validator.parse_time
+            result ['validate'] = validator.validate_time
+            result ['total'] = sum (result [phase] for phase in PHASES)
+            if best is None or result ['total'] < best ['total']:
+                best = result
+    finally:
+        shutil.rmtree (options.dest_dir, ignore_errors=True)
+
+    best ['elements_per_sec'] = best ['elements'] / best ['total'] if best ['total'] else 0
+    # kilobytes on Linux
+    best ['peak_mb'] = resource.getrusage (resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    return best
+
+def run_process (format, directory, repeat):
+    ''' run () in a fresh interpreter
+    '''
+    output = subprocess.check_output (
+        [sys.executable, os.path.abspath (__file__), '--run', format, '--corpus', directory, '--repeat', str (repeat)]
+    )
+    return json.loads (output)
+
+def print_table (results, previous=None):
+    print ("{0:<12} {1:>9} {2:>11} {3:>9} {4:>9} {5:>9} {6:>9} {7:>8}{8}".format (
+        'format', 'elements', 'elements/s', 'parse', 'validate', 'walk', 'write', 'peak',
+        '  vs previous' if previous else ''
+    ))
+    for format, result in results.items ():
+        line = "{0:<12} {elements:>9} {elements_per_sec:>11.0f} {1:>7.1f}ms {2:>7.1f}ms {3:>7.1f}ms {4:>7.1f}ms {peak_mb:>6.1f}MB".format (
+            format, *[result [phase] * 1e3 for phase in PHASES], **result
+        )
+        before = previous and previous.get (format)
+        if before:
+            line += "  {0:>10.2f}x".format (result ['elements_per_sec'] / before ['elements_per_sec'])
+        print (line)
+
+def main ():
+    parser = OptionParser (usage="%prog [options] [FORMAT ...]")
+    corpus_options (parser)
+    parser.set_defaults (repeat=3, corpus=None, json=None, compare=None, run=None)
+    parser.add_option ("--corpus", dest="corpus", help="generate the corpus in DIR and keep it [a temporary directory]", metavar="DIR")
+    parser.add_option ("-n", "--repeat", dest="repeat", help="convert the corpus N times, reporting the fastest [3]", metavar="N", type=int)
+    parser.add_option ("--json", dest="json", help="also write the results to FILE as JSON", metavar="FILE")
+    parser.add_option ("--compare", dest="compare", help="show the change in elements/s from the results in FILE, written by --json", metavar="FILE")
+    parser.add_option ("--run", dest="run", help=SUPPRESS_HELP, metavar="FORMAT")
+    (options, args) = parser.parse_args ()
+
+    if options.run:
+        # a child process of the suite: one format, results as JSON on stdout
+        print (json.dumps (run (options.run, options.corpus, options.repeat)))
+        return
+
+    formats = args or FORMATS
+    for format in formats:
+        if not os.path.exists (os.path.join (BASE_DIR, '%s.rules' % format)):
+            parser.error ("no rules file for format {0}".format (format))
+    previous = None
+    if options.compare:
+        with open (options.compare) as f:
+            previous = json.load (f)['formats']
+
+    directory = options.corpus or tempfile.mkdtemp ()
+    try:
+        corpus = settings (options)
+        corpus ['modules'] = options.modules
+        generate (directory, **corpus)
+        results = dict ((format, run_process (format, directory, options.repeat)) for format in formats)
+    finally:
+        if not options.corpus:
+            shutil.rmtree (directory, ignore_errors=True)
+
+    results = OrderedDict ((format, results [format]) for format in formats)
+    print ("corpus: {modules} modules of {directives} directives, lists {depth} deep, {siblings} siblings, {example_lines} line examples".format (**corpus))
+    print_table (results, previous)
+
+    if options.json:
+        with open (options.json, 'w') as f:
+            json.dump (dict (corpus=corpus, repeat=options.repeat, python=sys.version.split () [0], formats=results), f, indent=1, sort_keys=True)
+
+if __name__ == '__main__':
+    main ()
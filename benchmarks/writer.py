@@ -0,0 +1,62 @@
+#!/usr/bin/python
+# --------------------------------------------------------------------------
+# writer.py
+#
+# Renders the sample's directives with the rst rules into a temporary
+# directory, writing each fragment before rendering goes on versus handing
+# it to a background Writer.  Each write is delayed by LATENCY milliseconds
+# to stand in for slow (network) storage; 0 measures the local disk.
+#
+# usage: benchmarks/writer.py [LATENCY [THREADS]]
+# --------------------------------------------------------------------------
+
+from __future__ import print_function
+import sys
+import shutil
+import tempfile
+import time
+from common import load_rules, load_tree, directives, timeit, report
+import doc2
+from doc2 import Transformer, Writer, convert_element, option_parser
+
+
+def slow (store, latency):
+    def store_fragment (*args):
+        time.sleep (latency)
+        store (*args)
+    return store_fragment
+
+def render (processor, options, elements, threads):
+    ''' convert every element, each to a fresh fragment
+    '''
+    shutil.rmtree (options.dest_dir, ignore_errors=True)
+    doc2.made_dirs.clear ()
+    doc2.writer = Writer (threads) if threads else None
+    try:
+        for n, directive in enumerate (elements):
+            directive.set ('name', 'd{0}'.format (n))
+            convert_element ([processor], options, '', 'bench.xml', directive)
+    finally:
+        doc2.stop_writer ()
+
+def main (latency=2.0, threads=2):
+    options = option_parser ().get_default_values ()
+    options.src_dir = ''
+    options.dest_dir = tempfile.mkdtemp ()
+    processor = Transformer (load_rules ('rst'))
+    processor.set_srcfile ('bench.xml')
+    elements = directives (load_tree ()) * 10
+    doc2.store_fragment = slow (doc2.store_fragment, latency / 1e3)
+
+    print ("{0:<24} {1:>12} {2:>12} {3:>8}".format ('per fragment', 'before', 'after', 'speedup'))
+    try:
+        report ('{0}ms, {1} threads'.format (latency, threads),
+            timeit (lambda: render (processor, options, elements, 0), repeat=3, number=1),
+            timeit (lambda: render (processor, options, elements, threads), repeat=3, number=1),
+            len (elements)
+        )
+    finally:
+        shutil.rmtree (options.dest_dir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main (*[float (a) for a in sys.argv [1:2]] + [int (a) for a in sys.argv [2:3]])
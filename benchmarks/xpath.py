@@ -0,0 +1,48 @@
+#!/usr/bin/python
+# --------------------------------------------------------------------------
+# xpath.py
+#
+# Cost of computing element XPaths during the walk: getpath () for every
+# event, as Transformer.process_element used to, versus doc2.walk (), which
+# builds them from a stack of the open elements.  Uses a synthetic directive
+# with many para siblings, each holding a list with many listitems.
+#
+# usage: benchmarks/xpath.py [PARAS [LISTITEMS]]
+# --------------------------------------------------------------------------
+
+from __future__ import print_function
+import sys
+from common import timeit, report
+from lxml import etree
+from doc2 import walk
+
+
+def directive (paras, items):
+    root = etree.Element ('directive', name='bench')
+    for p in range (paras):
+        para = etree.SubElement (root, 'para')
+        para.text = 'para {0}'.format (p)
+        lst = etree.SubElement (para, 'list', type='bullet')
+        for i in range (items):
+            etree.SubElement (etree.SubElement (lst, 'listitem'), 'literal').text = str (i)
+    return root
+
+def getpath_walk (root):
+    tree = etree.ElementTree (root)
+    return [tree.getpath (elem) for event, elem in etree.iterwalk (root, events=('start', 'end'))]
+
+def stack_walk (root):
+    return [xpath for event, elem, xpath in walk (root)]
+
+def main (paras=1000, items=20):
+    print ("{0:<24} {1:>12} {2:>12} {3:>8}".format ('per event', 'getpath', 'walk', 'speedup'))
+    for p, i in (max (paras // 10, 1), max (items // 10, 1)), (paras, items):
+        root = directive (p, i)
+        paths = getpath_walk (root)
+        assert paths == stack_walk (root)
+        before = timeit (lambda: getpath_walk (root), repeat=3, number=3)
+        after = timeit (lambda: stack_walk (root), repeat=3, number=3)
+        report ('{0}x{1} ({2} events)'.format (p, i, len (paths)), before, after, len (paths))
+
+if __name__ == '__main__':
+    main (*[int (a) for a in sys.argv [1:]])
@@ -0,0 +1,115 @@
+#!/usr/bin/python
+# --------------------------------------------------------------------------
+# bundle.py
+#
+# A single-file alternative to doc2.py's tree of fragments.  With --bundle,
+# every fragment of a run is stored in one SQLite database, keyed by the path
+# it would have had below the destination directory and indexed by module
+# (the source file's name) and name (the ROOT element's attribute).
+#
+# Bundle is also the lookup API for readers of the database:
+#
+#   bundle = Bundle ('docs.db')
+#   text = bundle.get ('ngx_http_image_filter_module', 'image_filter', 'rst')
+#
+# or from the command line: bundle.py DATABASE MODULE NAME [DIRECTORY]
+# --------------------------------------------------------------------------
+
+from __future__ import print_function
+import sys
+import sqlite3
+
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS fragments (
+        path TEXT PRIMARY KEY,
+        directory TEXT NOT NULL,
+        module TEXT NOT NULL,
+        name TEXT NOT NULL,
+        text TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS fragments_module_name ON fragments (module, name, directory);
+'''
+
+
+class Bundle (object):
+    def __init__ (self, filename):
+        self.filename = filename
+        self.db = sqlite3.connect (filename)
+        self.db.text_factory = unicode
+        self.db.executescript (SCHEMA)
+        self.stored = set ()         # paths put () this session
+
+    def put (self, fragments):
+        ''' store (path, directory, module, name, text) fragments, leaving
+            identical ones untouched.  Returns the number (written, unchanged).
+        '''
+        fragments = list (fragments)
+        current = {}
+        paths = [f [0] for f in fragments]
+        for n in range (0, len (paths), 500):
+            chunk = paths [n:n + 500]
+            current.update (self.db.execute (
+                'SELECT path, text FROM fragments WHERE path IN ({0})'.format (','.join ('?' * len (chunk))), chunk
+            ))
+        changed = [f for f in fragments if current.get (f [0]) != f [4]]
+        self.db.executemany ('INSERT OR REPLACE INTO fragments VALUES (?, ?, ?, ?, ?)', changed)
+        self.stored.update (paths)
+        return len (changed), len (fragments) - len (changed)
+
+    def remove_unstored (self):
+        ''' delete the fragments put () didn't store this session, returning
+            their paths
+        '''
+        orphans = [path for (path,) in self.db.execute ('SELECT path FROM fragments') if path not in self.stored]
+        self.db.executemany ('DELETE FROM fragments WHERE path = ?', [(path,) for path in orphans])
+        return orphans
+
+    def commit (self):
+        self.db.commit ()
+
+    def close (self):
+        self.db.commit ()
+        self.db.close ()
+
+    def get (self, module, name, directory=None):
+        ''' the text of a fragment, or None.  Without a directory (the output
+            directory of a format, e.g. rst) any format's fragment may be
+            returned.
+        '''
+        query = 'SELECT text FROM fragments WHERE module = ? AND name = ?'
+        args = [module, name]
+        if directory is not None:
+            query += ' AND directory = ?'
+            args.append (directory)
+        row = self.db.execute (query + ' ORDER BY path LIMIT 1', args).fetchone ()
+        return row [0] if row else None
+
+    def names (self, module, directory=None):
+        ''' the names of a module's fragments
+        '''
+        query = 'SELECT DISTINCT name FROM fragments WHERE module = ?'
+        args = [module]
+        if directory is not None:
+            query += ' AND directory = ?'
+            args.append (directory)
+        return [name for (name,) in self.db.execute (query + ' ORDER BY name', args)]
+
+    def modules (self, directory=None):
+        query = 'SELECT DISTINCT module FROM fragments'
+        args = []
+        if directory is not None:
+            query += ' WHERE directory = ?'
+            args.append (directory)
+        return [module for (module,) in self.db.execute (query + ' ORDER BY module', args)]
+
+
+if __name__ == '__main__':
+    if len (sys.argv) not in (4, 5):
+        print ("usage: {0} DATABASE MODULE NAME [DIRECTORY]".format (sys.argv [0]), file=sys.stderr)
+        sys.exit (2)
+    text = Bundle (sys.argv [1]).get (*sys.argv [2:])
+    if text is None:
+        print ("no fragment {0}".format (' '.join (sys.argv [2:])), file=sys.stderr)
+        sys.exit (1)
+    sys.stdout.write (text.encode ('utf-8'))
@@ -14,28 +14,211 @@ from __future__ import print_function
 import os, sys, errno, traceback
 import logging; logging.basicConfig ()
 import re, string
+import ast, dis
+import __builtin__
+import hashlib
+import time
+import json
+import multiprocessing
+import threading
+import Queue
 from fnmatch import fnmatch
+from itertools import izip
 from glob import glob
 from cStringIO import StringIO
+from StringIO import StringIO as TextIO
 from lxml import etree
 from optparse import OptionParser
-from rulesparser import RulesParser
+from urlparse import urlparse, parse_qsl
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from rulesparser import RulesParser, LRUCache, RULE_ARGS, cache_file
+from manifest import Manifest, digest, remove as remove_fragments
+from bundle import Bundle
+from validation import Validator
+from profiler import Profile, clock, dump as dump_profiles
 try:
     from collections import OrderedDict
 except ImportError:
     from ordereddict import OrderedDict
 
 
+class RuleError (Exception):
+    ''' an exception raised by the code block of a rule
+    '''
+    def __init__ (self, rule, event, lineno, error, src):
+        Exception.__init__ (self, rule, event, lineno, error, src)
+        self.rule = rule
+        self.event = event
+        self.lineno = lineno
+        self.error = error
+        self.src = src
+
+    def __str__ (self):
+        return "\nError: {3}\nRule: {0}\nEvent: {1}\nLine {2}:\n\n{4}\n\n".format (
+            self.rule, self.event, self.lineno, self.error, self.src
+        )
+
+
+class Normalizer (object):
+    ''' the text normalization behind the sanitize and collapse directives,
+        using regexes compiled once.  sanitize () is a single pass over the
+        text: one regex matches any substituted character and each match is
+        replaced by looking it up, so every character maps exactly once.
+    '''
+    substitutions = {
+        u'\xa0': u' ',
+        u'\u201c': u'"',
+        u'\u201d': u'"',
+        u'\u2019': u"'",
+        u'\u2014': u'-',
+        u'\u2018': u'-',
+    }
+    whitespace = re.compile (ur'\s+')
+
+    def __init__ (self, substitutions=None):
+        ''' substitutions, {char: replacement or None to delete}, extend and
+            override the defaults
+        '''
+        table = dict (self.substitutions)
+        table.update (substitutions or {})
+        table = dict ((k, v or u'') for k, v in table.items ())
+        self._unicode = self.__compile (table)
+
+        # byte strings only ever match the characters below 256.  A byte
+        # string can't hold a replacement outside ascii, so if there is one
+        # byte strings that need sanitizing are decoded first
+        narrow = dict ((k.encode ('latin-1'), v) for k, v in table.items () if ord (k) < 256)
+        self._decode = any (ord (c) > 127 for v in narrow.values () for c in v)
+        if not self._decode:
+            narrow = dict ((k, v.encode ('ascii')) for k, v in narrow.items ())
+        self._bytes = self.__compile (narrow)
+
+    @staticmethod
+    def __compile (table):
+        ''' (regex matching any substituted char, function replacing a match)
+        '''
+        if not table:
+            return None, None
+        rx = re.compile ('[' + ''.join (re.escape (c) for c in sorted (table)) + ']')
+        return rx, lambda mo: table [mo.group ()]
+
+    def sanitize (self, t):
+        if isinstance (t, unicode):
+            rx, replace = self._unicode
+        else:
+            rx, replace = self._bytes
+            if rx is not None and self._decode and rx.search (t):
+                rx, replace = self._unicode
+                t = t.decode ('latin-1')
+        if rx is None:
+            return t
+        return rx.sub (replace, t)
+
+    def collapse (self, t):
+        return self.whitespace.sub (' ', t)
+
+
+# what makes a rule impure for the memo: the transformer state it reads or
+# changes, and the ways out of the element's subtree.  Besides these, reading
+# any variable a rule doesn't assign itself (a global) makes it impure
+IMPURE_NAMES = frozenset (('globals', 'last_output', 'filename', 'debug', 'store', 'retrieve', 'combine', 'newfile'))
+IMPURE_ATTRS = frozenset (('getparent', 'getprevious', 'getnext', 'itersiblings', 'iterancestors', 'getroottree', 'xpath'))
+BUILTINS = frozenset (dir (__builtin__))
+
+NAME_OPS = dict (
+    [(dis.opmap [op], 'load') for op in ('LOAD_NAME', 'LOAD_GLOBAL')] +
+    [(dis.opmap [op], 'store') for op in ('STORE_NAME', 'DELETE_NAME')] +
+    [(dis.opmap [op], 'global') for op in ('STORE_GLOBAL', 'DELETE_GLOBAL')] +
+    [(dis.opmap [op], 'attr') for op in ('LOAD_ATTR', 'STORE_ATTR', 'DELETE_ATTR')]
+)
+
+def code_names (code, names=None):
+    ''' the names a code object, and the functions and lambdas it defines,
+        uses: {'load': variables read, 'store': variables assigned, 'global':
+        globals assigned, 'attr': attributes got, set or deleted, 'free':
+        variables read before the code assigns them, or read by the
+        functions it defines, which exec () looks up in the globals}
+    '''
+    nested = names is not None
+    if names is None:
+        names = dict ((kind, set ()) for kind in ('load', 'store', 'global', 'attr', 'free'))
+    co, n, extended = code.co_code, 0, 0
+    while n < len (co):
+        op = ord (co [n])
+        if op < dis.HAVE_ARGUMENT:
+            n += 1
+            continue
+        arg = ord (co [n + 1]) + ord (co [n + 2]) * 256 + extended
+        extended = arg << 16 if op == dis.EXTENDED_ARG else 0
+        n += 3
+        if op in NAME_OPS:
+            name = code.co_names [arg]
+            if NAME_OPS [op] == 'load' and (nested or name not in names ['store']):
+                names ['free'].add (name)
+            names [NAME_OPS [op]].add (name)
+    for const in code.co_consts:
+        if hasattr (const, 'co_code'):
+            code_names (const, names)
+    return names
+
+
 class Transformer (object):
     def __init__ (self, config):
         self._cfg = config
         self._root = None            # root element to start processing at
         self._srcfile = None         # the filename currently being processed
         self._newfile = False        # flag that a new file should be generated
-        self._store = {}
+        self._prune = False          # flag that the element's descendants should be skipped
+        self._filename = None        # _srcfile without its extension
+        self._store = {}             # name -> list of stored texts
+        self._groups = {}            # (parent, combine) -> combined text
         self.last_output = ''
         self.directives = [f [len ('dd_'):] for f in dir (self) if f.startswith ('dd_')]
-        self._globals = {}
+        self._globals = {'__builtins__': __builtins__}
+        self.profile = None          # a profiler.Profile to record timings in
+        self.normalizer = Normalizer (self.__substitutions ())
+        self.memo = None             # LRUCache of rendered subtrees, see memoize ()
+        self.memo_stats = dict (hits=0, misses=0, uncacheable=0)
+        self._skip = None            # element whose subtree the memo rendered
+        self._recording = []         # [element, key, outputs, cacheable] of subtrees being rendered
+
+        # bound directive methods to apply for each (rule, event)
+        self._pipelines = dict (
+            ((rule, event), self.pipeline (rule, event))
+            for rule in self._cfg.rules () for event in ('start', 'end')
+        )
+
+        # (static settings, function, code object) to evaluate each rule with
+        self._blocks = dict (
+            ((rule, event), self.block (rule, event))
+            for rule in self._cfg.rules () for event in ('start', 'end')
+        )
+
+        # rules declaring pure = True, and whether each (rule, event) may be
+        # memoized, see memoize ()
+        self._pure = set (
+            rule for rule in self._cfg.rules ()
+            if str (self._cfg.settings (rule, 'start').get ('pure', '')).strip () == 'True'
+        )
+        self._impure = dict (
+            ((rule, event), self.impure (rule, event))
+            for rule in self._cfg.rules () for event in ('start', 'end')
+        )
+
+    def __substitutions (self):
+        ''' the sanitize setting of [info], a dict literal of extra character
+            substitutions
+        '''
+        setting = self._cfg.get ('info').get ('sanitize')
+        if not setting:
+            return None
+        try:
+            substitutions = ast.literal_eval (setting)
+            if not isinstance (substitutions, dict):
+                raise ValueError ("not a dict")
+            return dict ((unicode (k), v if v is None else unicode (v)) for k, v in substitutions.items ())
+        except (ValueError, SyntaxError), e:
+            raise ValueError ("Invalid sanitize setting in [info]: {0} ({1})".format (setting, e))
 
     def description (self):
         return self._cfg.get ('info')['description']
@@ -47,63 +230,237 @@ class Transformer (object):
         return self._cfg.get ('info')['directory']
 
     def set_srcfile (self, srcfile):
-        '''save a reference to the current xml file being processed
+        '''save a reference to the current xml file being processed and
+        drop any state left over from the previous one, so each file
+        converts the same no matter which files preceded it
         '''
         self._srcfile = srcfile
+        self._filename = os.path.splitext (srcfile)[0]
+        self._newfile = False
+        self._prune = False
+        self._skip = None
+        self._recording = []
+        self._store = {}
+        self.last_output = ''
+        # cleared in place, rule functions hold on to this dict
+        self._globals.clear ()
+        self._globals ['__builtins__'] = __builtins__
 
     def set_root (self, root):
         '''save a reference to the current root element
         '''
         self._root = etree.ElementTree (root)
+        self._groups.clear ()
+
+    def pipeline (self, rule, event):
+        ''' the directive methods a rule's event applies, in the order
+            the rule sets them
+        '''
+        return tuple (
+            getattr (self, "dd_{0}".format (directive))
+            for directive in self._cfg.directives (rule, event)
+            if directive in self.directives
+        )
 
-    def process_element (self, event, elem):
+    def block (self, rule, event):
+        ''' resolve how a rule's code block is evaluated: blocks that only
+            assign constants are replaced by their settings, others become
+            functions sharing this Transformer's globals
+        '''
+        static, code, obj = self._cfg.block (rule, event)
+        func = None
+        if code is not None:
+            ns = {}
+            exec (code, self._globals, ns)
+            func = ns ['rule']
+        return static, func, obj
+
+    def impure (self, rule, event):
+        ''' whether a rule's event reads or changes state outside the element
+            it is given (the last output, globals, stored texts, the
+            filename, other elements than its descendants), so that its output
+            can't be memoized
+        '''
+        obj = self._cfg.block (rule, event)[2]
+        if obj is None:
+            return False
+        names = code_names (obj)
+        free = names ['free'] - set (RULE_ARGS) - BUILTINS
+        return bool (
+            free or names ['global'] or names ['attr'] & IMPURE_ATTRS
+            or (names ['load'] | names ['store']) & IMPURE_NAMES
+        )
+
+    def memoize (self, size=4096):
+        ''' render the subtrees of elements matched by rules declaring
+            pure = True once and reuse the text for identical subtrees at the
+            same path: same tags, attributes, text and tail.  A subtree is only
+            stored if no rule applied to it is impure ().  The memo holds the
+            last size subtrees and lives as long as this Transformer, whose
+            rules it is only valid for.  Without pure rules this does nothing.
+        '''
+        if self._pure:
+            self.memo = LRUCache (size)
+
+    def evaluate (self, match, mo, event, elem, xpath):
+        ''' evaluate the code block of the rule matching an element,
+            returning the variables it leaves for the directives
+        '''
+        static, func, obj = self._blocks [match, event]
+        if static is not None:
+            # only the variables directives use besides the settings
+            vars = {'elem': elem, 'xpath': xpath}
+            vars.update (static)
+            return vars
+
+        try:
+            if func is not None:
+                return func (re, string, os, event, elem, self.last_output, mo, match, xpath, self._filename, self._globals)
+
+            vars = {
+                're': re,
+                'string': string,
+                'os': os,
+                'event': event,
+                'elem': elem,
+                'last_output': self.last_output,
+                'match': mo,
+                'regex': match,
+                'xpath': xpath,
+                'filename': self._filename,
+                'globals': self._globals
+            }
+            exec (obj, self._globals, vars)
+            return vars
+        except:
+            exc_type, exc_value, exc_traceback = sys.exc_info ()
+            tb = traceback.extract_tb (exc_traceback)
+            tb_rule, tb_lineno, _, _ = tb [1]
+            raise RuleError (match, event, tb_lineno, exc_value, self.dd_indent (self._cfg.src (match, event), indent=4))
+
+    def process_element (self, event, elem, xpath=None):
+        ''' process an event, xpath being elem's path as getpath () would
+            compute it relative to the root element, see walk ()
+        '''
+        if self.memo is None:
+            return self.__process_element (event, elem, xpath)
+        return self.__memo_element (event, elem, xpath)
+
+    def __memo_element (self, event, elem, xpath):
+        ''' process_element () with memoize (): a pure rule's element is
+            looked up on its start event, and on a hit the stored text is
+            returned for the whole subtree, whose other events are ignored
+            (and skipped by walk () if every processor agrees, see _prune).
+            Otherwise the outputs are recorded until its end event.
+        '''
+        if self._skip is not None:
+            if event == 'end' and elem is self._skip:
+                self._skip = None
+            return None
+
+        recording = self._recording
+        if event == 'end' and not recording:
+            return self.__process_element (event, elem, xpath)
+
+        if xpath is None:
+            xpath = self._root.getpath (elem)
+        match = self._cfg.search (xpath)[0]
+        if event == 'start' and match in self._pure:
+            tail = elem.tail or ''
+            data = etree.tostring (elem, encoding='utf-8', with_tail=False) + '\0' + tail.encode ('utf-8')
+            key = (xpath, hashlib.sha1 (data).digest ())
+            cached = self.memo.get (key)
+            if cached is not None:
+                self.memo_stats ['hits'] += 1
+                self._skip = elem
+                self._prune = True
+                text, last = cached
+                if last is None:
+                    return None
+                for r in recording:
+                    r [2].append (text)
+                self.last_output = last
+                return text
+            self.memo_stats ['misses'] += 1
+            recording.append ([elem, key, [], True])
+
+        t = self.__process_element (event, elem, xpath)
+        if not recording:
+            return t
+
+        if match is None or self._impure [match, event]:
+            for r in recording:
+                r [3] = False
+        if t is not None:
+            for r in recording:
+                r [2].append (t)
+
+        if event == 'end' and recording [-1][0] is elem:
+            _, key, outputs, cacheable = recording.pop ()
+            if cacheable:
+                # the last output only changes if the subtree output anything
+                self.memo.put (key, (''.join (outputs), self.last_output if outputs else None))
+            else:
+                self.memo_stats ['uncacheable'] += 1
+        return t
+
+    def __process_element (self, event, elem, xpath):
         logger = logging.getLogger (__name__)
+        profile = self.profile
+        if profile: start = clock ()
 
-        xpath = self._root.getpath (elem)
+        if xpath is None:
+            xpath = self._root.getpath (elem)
         match, mo = self._cfg.search (xpath)
 
         t = elem.text if event == 'start' else elem.tail
         if t is None: t = ''
 
         if match is None:
+            if profile: profile.miss (xpath, clock () - start)
             logger.warn ('No rule matching {0}, skipping...'.format (xpath))
             return
 
-        vars = {
-            're': re,
-            'string': string,
-            'os': os,
-            'event': event,
-            'elem': elem,
-            'last_output': self.last_output,
-            'match': mo,
-            'regex': match,
-            'xpath': xpath,
-            'filename': os.path.splitext (self._srcfile)[0],
-            'globals': self._globals
-        }
+        if profile:
+            entry = profile.entry (match, event)
+            entry [0] += 1
+            now = clock ()
+            entry [1] += now - start
+            start = now
 
-        try:
-            exec (self._cfg.obj (match, event), self._globals, vars)
-        except:
-            exc_type, exc_value, exc_traceback = sys.exc_info ()
-            tb = traceback.extract_tb (exc_traceback)
-            tb_rule, tb_lineno, _, _ = tb [1]
-            print ("\nError: {3}\nRule: {0}\nEvent: {1}\nLine {2}:\n".format (match, event, tb_lineno, exc_value), file=sys.stderr)
-            print ("{0}\n\n".format (self.dd_indent (self._cfg.src (match, event), indent=4)), file=sys.stderr)
-            sys.exit (1)
+        vars = self.evaluate (match, mo, event, elem, xpath)
+        if event == 'start' and vars.get ('prune'):
+            self._prune = True
+
+        if profile:
+            now = clock ()
+            entry [2] += now - start
 
         if vars.get ('debug', False):
             print ("\n{xpath}\n-----------------------------".format (**vars))
 
-        for directive in self._cfg.settings (match, event):
+        if profile:
+            return self.__profile_pipeline (t, vars, entry [3], self._pipelines [match, event])
+
+        for method in self._pipelines [match, event]:
+            t = method (t, **vars)
             if t is None: return
-            if directive in self.directives:
-                method = getattr (self, "dd_{0}".format (directive))
-                t = method (t, **vars)
 
-        if t is not None:
-            self.last_output = t
+        self.last_output = t
+        return t
+
+    def __profile_pipeline (self, t, vars, timings, pipeline):
+        ''' apply a pipeline as process_element () does, timing each directive
+        '''
+        for method in pipeline:
+            start = clock ()
+            t = method (t, **vars)
+            timing = timings.setdefault (method.__name__ [len ('dd_'):], [0, 0.0])
+            timing [0] += 1
+            timing [1] += clock () - start
+            if t is None: return
+
+        self.last_output = t
         return t
 
     #
@@ -125,17 +482,14 @@ class Transformer (object):
 
     def dd_sanitize (self, t, sanitize=True, **_):
         if sanitize:
-            t = re.sub (ur'\xa0', ' ', t)
-            t = re.sub (ur'[\u201c\u201d]', '"', t)
-            t = re.sub (ur'\u2019', "'", t)
-            t = re.sub (ur'[\u2014\u2018]', '-', t)
+            t = self.normalizer.sanitize (t)
         return t
 
     def dd_collapse (self, t, collapse=True, **_):
         ''' collapse sequences of spaces and newlines, replace non-ascii quotes
         '''
         if collapse:
-            t = re.sub (ur'\s+', ' ', t)
+            t = self.normalizer.collapse (t)
         return t
 
     def dd_strip (self, t, strip=False, debug=False, **_):
@@ -193,10 +547,17 @@ class Transformer (object):
         return suffix + t
 
     def dd_combine (self, t, elem=None, combine=None, debug=False, **_):
-        ''' combine all identical siblings in a single, comma-separated string
+        ''' combine all identical siblings in a single, comma-separated string.
+            The result is computed once per parent, as every sibling of a
+            group usually fires the same rule.
         '''
         if combine:
-            t = ', '.join ([c.text for c in elem.getparent().findall (combine)])
+            parent = elem.getparent ()
+            # the key keeps the parent's proxy, and so its identity, alive
+            try:
+                t = self._groups [parent, combine]
+            except KeyError:
+                t = self._groups [parent, combine] = ', '.join ([c.text for c in parent.findall (combine)])
             if debug:
                 print ("\tcombine ({0}) = {1}".format (combine, t), file=sys.stderr)
 
@@ -206,18 +567,17 @@ class Transformer (object):
         if store:
             if debug:
                 print ("\tstore ({0}, {1})".format (store, t), file=sys.stderr)
-            self._store.setdefault (store, [])
-            self._store [store].append (t)
+            self._store.setdefault (store, []).append (t)
             return None
         return t
 
     def dd_retrieve (self, t, retrieve=None, debug=False, **_):
         if retrieve:
             if retrieve in self._store:
-                t = ', '.join (self._store [retrieve])
+                # stored texts are only joined here, once
+                t = ', '.join (self._store.pop (retrieve))
                 if debug:
                     print ("\tretrieve ({0}) = {1}".format (retrieve, t), file=sys.stderr)
-                del self._store [retrieve]
         return t
 
     def dd_newfile (self, t, newfile=False, debug=False, **_):
@@ -227,83 +587,1040 @@ class Transformer (object):
         return t
 
 
+# fragments write_fragment () wrote, those already on disk as they were,
+# and orphaned fragments removed
+fragment_stats = dict (written=0, unchanged=0, removed=0)
+fragment_lock = threading.Lock ()
+
+def same_contents (filename, data):
+    ''' whether a file exists and holds exactly data
+    '''
+    try:
+        if os.path.getsize (filename) != len (data):
+            return False
+        with open (filename, 'rb') as f:
+            return f.read () == data
+    except (IOError, OSError):
+        return False
+
+# directories store_fragment () made or found, forgotten when fragments are
+# removed (which removes the directories they leave empty) or when writing
+# into one finds it gone
+made_dirs = set ()
+
+def make_dirs (directory):
+    ''' mkdir -p, once per directory
+    '''
+    if directory in made_dirs:
+        return
+    try:
+        os.makedirs (directory)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+    made_dirs.add (directory)
+
+def store_fragment (target_dir, output_file, text):
+    ''' write a fragment, unless the file on disk already has the same
+        contents (leaving it and its mtime alone).  Others are replaced
+        atomically.
+    '''
+    make_dirs (target_dir)
+    data = text.encode ('utf-8')
+    if same_contents (output_file, data):
+        with fragment_lock:
+            fragment_stats ['unchanged'] += 1
+        return
+
+    tmp = output_file + '.tmp'
+    try:
+        fragment = open (tmp, 'wb')
+    except IOError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        # the directory was removed since make_dirs () made it
+        made_dirs.discard (target_dir)
+        make_dirs (target_dir)
+        fragment = open (tmp, 'wb')
+    with fragment:
+        fragment.write (data)
+    os.rename (tmp, output_file)
+    with fragment_lock:
+        fragment_stats ['written'] += 1
+
+
+class Writer (object):
+    ''' store_fragment () from a pool of threads, so rendering goes on while
+        fragments are written.  Each thread drains its own bounded queue and
+        a fragment's file always goes to the same thread, so writes to one
+        file happen in the order they were queued.  The first error stops
+        all writing and is raised by the next put (), flush () or close ().
+    '''
+    def __init__ (self, threads=2, size=64):
+        self.queues = [Queue.Queue (size) for n in range (max (threads, 1))]
+        self.error = None            # sys.exc_info () of the first failed write
+        self.threads = [threading.Thread (target=self.run, args=(queue,)) for queue in self.queues]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start ()
+
+    def run (self, queue):
+        while True:
+            fragment = queue.get ()
+            try:
+                if fragment is None:
+                    return
+                if self.error is None:
+                    store_fragment (*fragment)
+            except Exception:
+                if self.error is None:
+                    self.error = sys.exc_info ()
+            finally:
+                queue.task_done ()
+
+    def check (self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error [0], error [1], error [2]
+
+    def put (self, target_dir, output_file, text):
+        ''' queue a fragment, waiting only if its thread is that far behind
+        '''
+        self.check ()
+        self.queues [hash (output_file) % len (self.queues)].put ((target_dir, output_file, text))
+
+    def flush (self):
+        ''' wait until every queued fragment is on disk
+        '''
+        for queue in self.queues:
+            queue.join ()
+        self.check ()
+
+    def close (self):
+        ''' write the queued fragments and stop the threads
+        '''
+        for queue in self.queues:
+            queue.put (None)
+        for thread in self.threads:
+            thread.join ()
+        self.check ()
+
+# the Writer write_fragment () queues fragments for, None to write them
+# before returning, see start_writer ()
+writer = None
+
+def start_writer (options):
+    global writer
+    if options.writers and not options.bundle:
+        writer = Writer (options.writers)
+
+def flush_writer ():
+    if writer is not None:
+        writer.flush ()
+
+def stop_writer ():
+    global writer
+    if writer is not None:
+        writer, stopping = None, writer
+        stopping.close ()
+
+def write_fragment (processor, options, root, srcfile, element, text):
+    ''' write the output of a root element to its own file, returning the
+        file's name.  With a writer, the file is written in the background.
+    '''
+    logger = logging.getLogger (__name__)
+
+    target_dir = os.path.join (options.dest_dir, processor.directory (), root.replace (options.src_dir, ''), os.path.splitext (os.path.basename (srcfile))[0])
+    output_file = '{0}.{1}'.format (os.path.join (target_dir, element.get (options.fname_attribute)), processor.extension ())
+    logger.debug ("      -> {0}".format (output_file))
+
+    if writer is not None:
+        writer.put (target_dir, output_file, text)
+    else:
+        store_fragment (target_dir, output_file, text)
+    return output_file
+
+# fragments bundle_fragment () produced, waiting for store_bundled ()
+bundled = []
+
+def bundle_fragment (processor, options, root, srcfile, element, text):
+    ''' with --bundle, queue the output of a root element for the bundle
+        instead of writing a file.  Returns the path the file would have
+        had below the destination directory, its key in the bundle.
+    '''
+    module = os.path.splitext (os.path.basename (srcfile))[0]
+    name = element.get (options.fname_attribute)
+    path = os.path.join (processor.directory (), root.replace (options.src_dir, ''), module, '{0}.{1}'.format (name, processor.extension ()))
+    logging.getLogger (__name__).debug ("      -> {0}: {1}".format (options.bundle, path))
+    bundled.append ((path, processor.directory (), module, name, unicode (text)))
+    return path
+
+def store_bundled (bundle):
+    written, unchanged = bundle.put (bundled)
+    del bundled [:]
+    fragment_stats ['written'] += written
+    fragment_stats ['unchanged'] += unchanged
+
+# subtrees walk () skipped, unless given other stats to count them in
+walk_stats = dict (pruned=0)
+
+def walk (root, prune=None, stats=walk_stats):
+    ''' iterwalk an element, generating (event, element, xpath) where xpath
+        is what etree.ElementTree (root).getpath (element) returns.  Paths
+        are built from a stack of the open elements instead, each step
+        being the tag and, if the parent has several children with that
+        tag, the position among them.
+
+        prune () is called after each start event has been consumed, if it
+        returns True the element's descendants are skipped (its end event
+        still follows) and counted in stats.
+    '''
+    tree = etree.ElementTree (root)
+    stack = []          # [path, path for children, tag totals, tags seen]
+
+    walker = etree.iterwalk (root, events=('start', 'end'))
+    for event, elem in walker:
+        if event == 'end':
+            yield event, elem, stack.pop () [0]
+            continue
+
+        tag = elem.tag
+        if not stack:
+            path = tree.getpath (elem)
+            base = '/' + tag if isinstance (tag, basestring) and tag [:1] != '{' else None
+        elif stack [-1][1] is None or not isinstance (tag, basestring) or tag [:1] == '{':
+            # namespaced elements, comments, etc: leave it to libxml2
+            path = base = tree.getpath (elem)
+        else:
+            parent = stack [-1]
+            if parent [2] is None:
+                totals = parent [2] = {}
+                for child in elem.getparent ():
+                    totals [child.tag] = totals.get (child.tag, 0) + 1
+            seen = parent [3]
+            n = seen [tag] = seen.get (tag, 0) + 1
+            if parent [2][tag] > 1:
+                path = base = '{0}/{1}[{2}]'.format (parent [1], tag, n)
+            else:
+                path = base = '{0}/{1}'.format (parent [1], tag)
+
+        stack.append ([path, base, None, {}])
+        yield event, elem, path
+
+        if prune is not None and prune () and len (elem):
+            walker.skip_subtree ()
+            stats ['pruned'] += 1
+
+def pruner (processors):
+    ''' the prune () for walk () feeding events to processors: a subtree is
+        only skipped if every format's rules prune it
+    '''
+    def prune ():
+        pruned = all (processor._prune for processor in processors)
+        for processor in processors:
+            processor._prune = False
+        return pruned
+    return prune
+
+def convert_element (processors, options, root, srcfile, directive, write=write_fragment, stats=walk_stats):
+    ''' walk a root element once, feeding its events to every processor.
+        Each fragment is handed to write (), which returns its name, and the
+        names are returned.  Pruned subtrees are counted in stats.
+    '''
+    fragments = []
+    for processor in processors:
+        processor.set_root (directive)
+    outputs = [StringIO () for processor in processors]
+
+    # process element's tree
+    for event, element, xpath in walk (directive, pruner (processors), stats):
+        for i, processor in enumerate (processors):
+            t = processor.process_element (event, element, xpath)
+            if t is not None:
+                try:
+                    outputs [i].write (t)
+                except UnicodeError, e:
+                    print (u"\n\nUnicode error processing the following text:\n{0}\n\n".format (t), file=sys.stderr)
+                    raise
+
+            if processor._newfile:
+                fragments.append (write (processor, options, root, srcfile, element, outputs [i].getvalue ()))
+                outputs [i] = StringIO ()
+                processor._newfile = False
+
+    return fragments
+
+def convert (processors, validator, options, root, filename, tree=None, write=None):
+    ''' convert a single XML file, writing a fragment for each root element.
+        The file is parsed once (unless an already parsed tree is given) and
+        its events are fed to every processor.  Returns the fragments written.
+    '''
+    if write is None:
+        write = bundle_fragment if options.bundle else write_fragment
+    logger = logging.getLogger (__name__)
+    fragments = []
+
+    for processor in processors:
+        processor.set_srcfile (os.path.join (root.replace (options.src_dir, ''), filename))
+    srcfile = os.path.join (root, filename)
+
+    if options.stream:
+        logger.debug ("  processing: {0}".format (os.path.basename (srcfile)))
+        return convert_stream (processors, validator, options, root, srcfile, write)
+
+    if tree is None:
+        tree = validator.parse (srcfile)
+    logger.debug ("  processing: {0}".format (os.path.basename (srcfile)))
+
+    # for each element, in its own output file
+    for directive in tree.xpath (options.root_element):
+        fragments.extend (convert_element (processors, options, root, srcfile, directive, write))
+
+    return fragments
+
+
+# --------------------------------------------------------------------------
+# streaming conversion
+#
+# With --stream a source is read with iterparse and each root element is
+# converted as soon as it closes.  Afterwards it is cleared, as is every
+# element outside a root element once it closes, so memory is bounded by the
+# largest root element rather than the whole document.  Cleared elements are
+# kept as empty placeholders so XPath positions stay the same.
+#
+# Only root elements given as //TAG or /PATH/TO/TAG can be streamed, and rules
+# only see the root element's subtree and its ancestors.  A root element's own
+# XPath can lack a trailing [1] when its later siblings haven't been read yet.
+# --------------------------------------------------------------------------
+def root_matcher (root_element):
+    ''' return a predicate testing whether an element is a root element, or
+        None if root_element can't be matched while streaming
+    '''
+    mo = re.match (r'^(//|/)([\w.-]+(?:/[\w.-]+)*)$', root_element)
+    if not mo:
+        return None
+
+    steps = mo.group (2).split ('/')
+    if mo.group (1) == '//' and len (steps) == 1:
+        return lambda elem: elem.tag == steps [0]
+    if mo.group (1) == '/':
+        def is_root (elem):
+            path = [elem.tag] + [a.tag for a in elem.iterancestors ()]
+            return path [::-1] == steps
+        return is_root
+    return None
+
+def convert_stream (processors, validator, options, root, srcfile, write=write_fragment):
+    ''' convert a source while it is parsed, clearing each root element once
+        it is rendered.  The rendered fragments are held until the whole
+        source has parsed and validated, so an invalid source writes none.
+    '''
+    is_root = root_matcher (options.root_element)
+    pending = []
+
+    def queue (processor, options, root, srcfile, element, text):
+        # the element is cleared before the fragment is written, keep its attributes
+        pending.append ((processor, etree.Element (element.tag, element.attrib), text))
+
+    for event, elem in validator.iterparse (srcfile, events=('end',)):
+        if not isinstance (elem.tag, basestring):
+            continue    # comments and processing instructions
+        if is_root (elem):
+            if any (is_root (a) for a in elem.iterancestors ()):
+                raise ValueError ("{0}: nested root elements can't be streamed".format (srcfile))
+            convert_element (processors, options, root, srcfile, elem, queue)
+            elem.clear ()
+        elif not any (is_root (a) for a in elem.iterancestors ()):
+            elem.clear ()
+
+    return [write (processor, options, root, srcfile, element, text) for processor, element, text in pending]
+
+
+# --------------------------------------------------------------------------
+# parallel conversion
+#
+# Each pool process loads its own rules, Transformers and Validator.  Output
+# a file produces on stdout/stderr (logging, debug prints, diagnostics) is
+# captured and handed back to the parent, which replays it in source order.
+# --------------------------------------------------------------------------
+_worker = None
+
+def rules_file (options, format):
+    return os.path.join (options.rules_dir, '%s.rules' % format)
+
+def load (options):
+    ''' load the rules file of each format, returning a Transformer per
+        format and a Validator to parse sources with
+    '''
+    processors = []
+    for format in options.formats:
+        filename = rules_file (options, format)
+        rules = RulesParser ()
+        rules.load (filename, cache_file (filename) if options.rules_cache else None)
+        processor = Transformer (rules)
+        if options.memoize:
+            processor.memoize ()
+        processors.append (processor)
+    return processors, Validator (options.cache_dtd, options.validation_cache)
+
+def init_worker (options):
+    global _worker
+    processors, validator = load (options)
+    if options.profile:
+        for processor in processors:
+            processor.profile = Profile ()
+    start_writer (options)
+    _worker = (processors, validator, options)
+
+def convert_worker (job):
+    ''' convert one file in a pool process.  Returns the fragments written,
+        its captured stdout and stderr, the error that stopped it (if any)
+        and the statistics it added, for merge_stats ().
+    '''
+    processors, validator, options = _worker
+    del bundled [:]
+    caches = [processor._cfg.cache for processor in processors]
+    counts = [(cache.hits, cache.misses) for cache in caches]
+    written = dict (fragment_stats)
+    walked = dict (walk_stats)
+    memoized = [dict (processor.memo_stats) for processor in processors]
+    handlers = logging.getLogger ().handlers
+    saved = sys.stdout, sys.stderr, [h.stream for h in handlers]
+    sys.stdout, sys.stderr = TextIO (), TextIO ()
+    for h in handlers:
+        h.stream = sys.stderr
+
+    fragments, error = [], None
+    try:
+        fragments = convert (processors, validator, options, *job)
+        flush_writer ()
+    except RuleError, e:
+        error = str (e)
+    except Exception:
+        error = traceback.format_exc ()
+    finally:
+        out, err = sys.stdout.getvalue (), sys.stderr.getvalue ()
+        sys.stdout, sys.stderr, streams = saved
+        for h, stream in zip (handlers, streams):
+            h.stream = stream
+
+    stats = dict (
+        caches = [(cache.hits - hits, cache.misses - misses) for cache, (hits, misses) in zip (caches, counts)],
+        validator = validator.drain (),
+        fragments = dict ((k, v - written [k]) for k, v in fragment_stats.items ()),
+        bundled = bundled [:],
+        walk = dict ((k, v - walked [k]) for k, v in walk_stats.items ()),
+        memo = [
+            dict ((k, v - before [k]) for k, v in processor.memo_stats.items ())
+            for processor, before in zip (processors, memoized)
+        ],
+        profiles = [processor.profile and processor.profile.drain () for processor in processors]
+    )
+    return fragments, out, err, error, stats
+
+def merge_stats (processors, validator, stats):
+    ''' add the statistics a pool process collected to the parent's
+    '''
+    validator.merge (stats ['validator'])
+    for k, v in stats ['fragments'].items ():
+        fragment_stats [k] += v
+    bundled.extend (stats ['bundled'])
+    for k, v in stats ['walk'].items ():
+        walk_stats [k] += v
+    for processor, (hits, misses), memo, profile in zip (processors, stats ['caches'], stats ['memo'], stats ['profiles']):
+        processor._cfg.cache.hits += hits
+        processor._cfg.cache.misses += misses
+        for k, v in memo.items ():
+            processor.memo_stats [k] += v
+        if profile:
+            processor.profile.merge (profile)
+
+def convert_all (processors, validator, options, jobs):
+    ''' convert each (root, filename) in jobs, serially or in a pool,
+        generating (job, fragments) in order.  Exits on the first error.
+    '''
+    if options.jobs == 1:
+        for job in jobs:
+            try:
+                yield job, convert (processors, validator, options, *job)
+            except RuleError, e:
+                print (e, file=sys.stderr)
+                sys.exit (1)
+        return
+
+    pool = multiprocessing.Pool (options.jobs or None, init_worker, (options,))
+    try:
+        results = pool.imap (convert_worker, jobs)
+        for job, (fragments, out, err, error, stats) in izip (jobs, results):
+            sys.stdout.write (out)
+            sys.stderr.write (err)
+            merge_stats (processors, validator, stats)
+            if error:
+                print (error, file=sys.stderr)
+                pool.terminate ()
+                sys.exit (1)
+            yield job, fragments
+        pool.close ()
+    finally:
+        pool.join ()
+
+
+# --------------------------------------------------------------------------
+# watch mode
+#
+# With --watch doc2.py stays running, polling the sources and rules files and
+# converting sources as they change.  The rules, the DTDs and the parsed
+# trees stay in memory: an edited source is the only file parsed, and a
+# changed rules file is reloaded and every source reconverted from its cached
+# tree.  Fragments a source no longer produces are removed.
+#
+# --serve adds a small HTTP interface on the loopback address for rendering
+# a source or an XML snippet on demand, without writing any files.
+# --------------------------------------------------------------------------
+def stamp (filename):
+    st = os.stat (filename)
+    return st.st_mtime, st.st_size
+
+class Watcher (object):
+    def __init__ (self, options, processors, validator):
+        self.options = options
+        self.processors = processors
+        self.validator = validator
+        self.formats = OrderedDict (zip (options.formats, processors))
+        self.rules_files = [rules_file (options, format) for format in options.formats]
+        self.rules = self.rules_stamps ()
+        self.sources = {}            # (root, filename) -> stamp when converted
+        self.paths = {}              # source relative to SRC -> (root, filename)
+        self.trees = {}              # (root, filename) -> (stamp, tree)
+        self.fragments = {}          # (root, filename) -> fragments written
+        self.conversions = 0
+        self.errors = 0
+
+    def rules_stamps (self):
+        ''' the stamps of the rules files, None for one that is missing (as
+            it briefly is while an editor replaces it)
+        '''
+        stamps = {}
+        for f in self.rules_files:
+            try:
+                stamps [f] = stamp (f)
+            except OSError:
+                stamps [f] = None
+        return stamps
+
+    def source (self, job):
+        root, filename = job
+        return os.path.join (root.replace (self.options.src_dir, ''), filename)
+
+    def scan (self):
+        ''' the sources to convert, with their stamps
+        '''
+        found = {}
+        for root, folders, files in os.walk (self.options.src_dir):
+            for filename in files:
+                if fnmatch (filename, self.options.pattern):
+                    try:
+                        found [root, filename] = stamp (os.path.join (root, filename))
+                    except OSError:
+                        pass    # removed while scanning
+        self.paths = dict ((self.source (job), job) for job in found)
+        return found
+
+    def tree (self, job, st):
+        ''' the parsed tree of a source, reparsed only if it changed
+        '''
+        cached = self.trees.get (job)
+        if cached and cached [0] == st:
+            return cached [1]
+        tree = self.validator.parse (os.path.join (*job))
+        self.trees [job] = (st, tree)
+        return tree
+
+    def reload (self):
+        ''' reload the rules after a rules file changed.  The previous rules
+            stay in use if the new ones fail to load.
+        '''
+        logger = logging.getLogger (__name__)
+        self.rules = self.rules_stamps ()
+        try:
+            processors, _ = load (self.options)
+        except SystemExit:
+            # the rules parser has already printed the error
+            logger.error ("watch: keeping the previous rules")
+            return
+        except Exception:
+            print (traceback.format_exc (), file=sys.stderr)
+            logger.error ("watch: keeping the previous rules")
+            return
+
+        self.processors = processors
+        self.formats = OrderedDict (zip (self.options.formats, processors))
+        self.sources = {}
+        logger.info ("watch: reloaded {0}".format (', '.join (self.rules_files)))
+
+    def poll (self):
+        ''' convert the sources that changed since the last poll (all of
+            them if the rules changed), returning them
+        '''
+        logger = logging.getLogger (__name__)
+        # a missing rules file counts as unchanged until it is back
+        stamps = self.rules_stamps ()
+        if None not in stamps.values () and stamps != self.rules:
+            self.reload ()
+
+        found = self.scan ()
+        for job in set (self.sources) - set (found):
+            for fragment in remove_fragments (self.fragments.pop (job, ()), self.options.dest_dir):
+                logger.debug ("      removed {0}".format (fragment))
+                fragment_stats ['removed'] += 1
+            del self.sources [job]
+            self.trees.pop (job, None)
+            made_dirs.clear ()
+            logger.info ("watch: {0} removed".format (self.source (job)))
+
+        changed = sorted (job for job, st in found.items () if self.sources.get (job) != st)
+        for job in changed:
+            self.sources [job] = found [job]
+            self.convert (job, found [job])
+        return changed
+
+    def convert (self, job, st):
+        ''' convert a source, reporting errors instead of exiting
+        '''
+        logger = logging.getLogger (__name__)
+        start = clock ()
+        try:
+            fragments = convert (self.processors, self.validator, self.options, *job, tree=self.tree (job, st))
+            flush_writer ()
+        except RuleError, e:
+            print (e, file=sys.stderr)
+            self.errors += 1
+            return
+        except Exception:
+            print (traceback.format_exc (), file=sys.stderr)
+            self.errors += 1
+            return
+
+        stale = set (self.fragments.get (job, ())) - set (fragments)
+        for fragment in remove_fragments (sorted (stale), self.options.dest_dir):
+            logger.debug ("      removed {0}".format (fragment))
+            fragment_stats ['removed'] += 1
+        if stale:
+            made_dirs.clear ()
+        self.fragments [job] = fragments
+        self.conversions += 1
+        logger.info ("watch: converted {0} in {1:.1f}ms, {2} fragments".format (
+            self.source (job), (clock () - start) * 1e3, len (fragments)
+        ))
+
+    def render (self, format=None, data=None, filename=None):
+        ''' render an XML snippet, or a source given relative to SRC, with
+            the rules of one format.  Nothing is written, a list of (name,
+            text) is returned for the root elements.
+        '''
+        processor = self.formats.get (format or self.options.formats [0])
+        if processor is None:
+            raise ValueError ("format {0} isn't loaded, use one of {1}".format (format, ', '.join (self.formats)))
+
+        rendered = []
+        def collect (processor, options, root, srcfile, element, text):
+            name = element.get (options.fname_attribute)
+            rendered.append ((name, text))
+            return name
+
+        if data is not None:
+            base_url = os.path.join (self.options.src_dir, 'request.xml')
+            tree = etree.ElementTree (etree.fromstring (data, self.validator.parser, base_url=base_url))
+            processor.set_srcfile ('request.xml')
+            for directive in tree.xpath (self.options.root_element):
+                convert_element ([processor], self.options, self.options.src_dir, base_url, directive, collect)
+        else:
+            self.scan ()
+            job = self.paths.get (os.path.normpath (filename))
+            if job is None:
+                raise ValueError ("no source {0} in {1}".format (filename, self.options.src_dir))
+            tree = self.tree (job, stamp (os.path.join (*job)))
+            convert ([processor], self.validator, self.options, *job, tree=tree, write=collect)
+        return rendered
+
+    def status (self):
+        return dict (
+            formats = list (self.formats), sources = len (self.sources),
+            conversions = self.conversions, errors = self.errors, fragments = fragment_stats
+        )
+
+class RenderHandler (BaseHTTPRequestHandler):
+    ''' GET /render?file=SOURCE[&format=FORMAT] renders a source below SRC,
+        POST /render[?format=FORMAT] the XML snippet in the request body and
+        GET /status reports what the watcher has done.  Responses are JSON.
+    '''
+    def do_GET (self):
+        url = urlparse (self.path)
+        query = dict (parse_qsl (url.query))
+        if url.path == '/status':
+            self.respond (200, self.server.watcher.status ())
+        elif url.path == '/render' and 'file' in query:
+            self.render (query.get ('format'), filename=query ['file'])
+        else:
+            self.respond (404, dict (error="unknown request {0}".format (self.path)))
+
+    def do_POST (self):
+        url = urlparse (self.path)
+        query = dict (parse_qsl (url.query))
+        if url.path == '/render':
+            self.render (query.get ('format'), data=self.rfile.read (int (self.headers.get ('Content-Length', 0))))
+        else:
+            self.respond (404, dict (error="unknown request {0}".format (self.path)))
+
+    def render (self, format, **kw):
+        start = clock ()
+        try:
+            rendered = self.server.watcher.render (format, **kw)
+        except (ValueError, RuleError, etree.LxmlError), e:
+            return self.respond (400, dict (error=str (e)))
+        except Exception:
+            return self.respond (500, dict (error=traceback.format_exc ()))
+        self.respond (200, dict (
+            fragments = [dict (name=name, text=text) for name, text in rendered],
+            time = clock () - start
+        ))
+
+    def respond (self, code, result):
+        body = json.dumps (result)
+        self.send_response (code)
+        self.send_header ('Content-Type', 'application/json')
+        self.send_header ('Content-Length', str (len (body)))
+        self.end_headers ()
+        self.wfile.write (body)
+
+    def log_message (self, format, *args):
+        logging.getLogger (__name__).debug ("serve: " + format % args)
+
+def watch (options, processors, validator):
+    ''' convert sources as they change until interrupted, serving render
+        requests if options.serve is set
+    '''
+    logger = logging.getLogger (__name__)
+    watcher = Watcher (options, processors, validator)
+    server = None
+    if options.serve:
+        host, _, port = options.serve.rpartition (':')
+        server = HTTPServer ((host or '127.0.0.1', int (port)), RenderHandler)
+        server.timeout = options.interval
+        server.watcher = watcher
+        logger.info ("watch: serving on http://{0}:{1}/".format (*server.server_address))
+
+    logger.info ("watch: polling {0} every {1}s".format (options.src_dir, options.interval))
+    try:
+        while True:
+            watcher.poll ()
+            if server:
+                server.handle_request ()
+            else:
+                time.sleep (options.interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if server:
+            server.server_close ()
+        validator.save ()
+
+
+# --------------------------------------------------------------------------
+# library API
+#
+# Converter loads the rules of some formats once and converts sources to
+# fragments in memory, {name: text}, without writing anything:
+#
+#   import doc2
+#   converter = doc2.Converter (['rst', 'mediawiki'])
+#   fragments = converter.convert (xml_bytes, 'rst')
+#   for path, formats in converter.convert_many (paths):
+#       ...
+#
+# The settings are the command line options' (root_element, fname_attribute,
+# cache_dtd, ...) and default to theirs.  Rules files are looked up next to
+# doc2.py unless rules_dir is given.  Rules see a source's name relative to
+# src_dir, as with doc2.py -s, or its base name without one.
+# --------------------------------------------------------------------------
+BASE_DIR = os.path.dirname (os.path.abspath (__file__))
+
+class Converter (object):
+    ''' converts sources in memory with the rules of some formats.  Each
+        Converter keeps its own Transformers, Validator and statistics, so
+        several can be used at once, but a Converter itself must only be
+        used by one thread at a time.
+    '''
+    def __init__ (self, formats=('rst',), rules_dir=BASE_DIR, src_dir=None, **settings):
+        self.options = option_parser ().get_default_values ()
+        self.options.formats = list (formats)
+        self.options.rules_dir = rules_dir
+        self.options.src_dir = src_dir
+        for k, v in settings.items ():
+            if not hasattr (self.options, k):
+                raise TypeError ("unknown setting {0}".format (k))
+            setattr (self.options, k, v)
+        self.processors, self.validator = load (self.options)
+        self.formats = OrderedDict (zip (self.options.formats, self.processors))
+        # strings are validated separately, and only if they have a DOCTYPE
+        self.parser = etree.XMLParser (load_dtd=True)
+        self.walk_stats = dict (pruned=0)
+
+    def __collector (self, rendered):
+        ''' a write () for convert_element () adding each fragment to
+            rendered [format][name]
+        '''
+        formats = dict ((id (processor), format) for format, processor in self.formats.items ())
+        def collect (processor, options, root, srcfile, element, text):
+            name = element.get (options.fname_attribute)
+            rendered [formats [id (processor)]][name] = text
+            return name
+        return collect
+
+    def __processors (self, formats):
+        try:
+            return [self.formats [format] for format in formats]
+        except KeyError, e:
+            raise ValueError ("format {0} isn't loaded, use one of {1}".format (e.args [0], ', '.join (self.formats)))
+
+    def srcfile (self, path):
+        ''' the name rules see for a source: relative to src_dir, as doc2.py
+            names the sources below SRC, or the base name
+        '''
+        if self.options.src_dir:
+            relative = os.path.relpath (path, self.options.src_dir)
+            if not relative.startswith (os.pardir):
+                return relative
+        return os.path.basename (path)
+
+    def __render (self, processors, tree, path, collect):
+        for processor in processors:
+            processor.set_srcfile (self.srcfile (path))
+        for directive in tree.xpath (self.options.root_element):
+            convert_element (processors, self.options, '', path, directive, collect, self.walk_stats)
+
+    def convert (self, source, format=None, base_url=None):
+        ''' convert a parsed tree or element, or XML given as a string, with
+            the rules of one format (the first loaded by default).  base_url
+            is where relative DTD and entity references in a string resolve
+            from, and the source's name.  A string is validated if it has a
+            DOCTYPE, never skipping that with the validation cache as the
+            file at base_url may differ.  Returns an OrderedDict {name: text}
+            of the fragments.
+        '''
+        format = format or self.options.formats [0]
+        processors = self.__processors ([format])
+        path = base_url or 'string.xml'
+
+        if isinstance (source, basestring):
+            tree = etree.ElementTree (etree.fromstring (source, self.parser, base_url=base_url))
+            if tree.docinfo.system_url:
+                dtd, _ = self.validator.dtd (path, tree)
+                dtd.assertValid (tree)
+        elif isinstance (source, etree._Element):
+            tree = etree.ElementTree (source)
+        else:
+            tree = source
+
+        rendered = {format: OrderedDict ()}
+        self.__render (processors, tree, path, self.__collector (rendered))
+        return rendered [format]
+
+    def convert_many (self, paths, formats=None):
+        ''' convert XML files, each parsed (and validated) once and rendered
+            in every format, generating (path, {format: {name: text}}) in
+            order.  Errors propagate: RuleError from rules, lxml's for XML.
+        '''
+        formats = list (formats or self.options.formats)
+        processors = self.__processors (formats)
+        for path in paths:
+            rendered = OrderedDict ((format, OrderedDict ()) for format in formats)
+            self.__render (processors, self.validator.parse (path), path, self.__collector (rendered))
+            yield path, rendered
+
+
 # --------------------------------------------------------------------------
 # main
 # --------------------------------------------------------------------------
 verbosity_levels = dict (debug=logging.DEBUG, info=logging.INFO, warn=logging.WARN, error=logging.ERROR, crit=logging.CRITICAL)
 available_formats = [os.path.splitext (f)[0] for f in glob ("*.rules")]
 
-parser = OptionParser ()
-parser.set_defaults (format='text', dest_dir='processed', pattern='*.xml', verbosity='warn', root_element='//directive', fname_attribute='name', src_dir='src')
-parser.add_option ("-s", "--source", dest="src_dir", help="source directory for XML files", metavar="SRC")
-parser.add_option ("-d", "--destination", dest="dest_dir", help="destination directory", metavar="DIR")
-parser.add_option ("-p", "--pattern", dest="pattern", help="convert files matching pattern", metavar="PATTERN")
-parser.add_option ("-r", "--root", dest="root_element", help="the root element, files will be split at every one of these", metavar="ROOT")
-parser.add_option ("-a", "--attribute", dest="fname_attribute", help="files will be named for this attribute of the ROOT element", metavar="ATTR")
-parser.add_option ("-f", "--format", dest="format", help="output format [{0}]".format ('|'.join (available_formats)), metavar="FORMAT")
-parser.add_option ("-v", "--verbosity", dest="verbosity", help="set verbosity [{0}]".format ('|'.join (verbosity_levels)), metavar="LEVEL")
-(options, args) = parser.parse_args ()
 
-if options.format not in available_formats:
-    parser.error ("Invalid output format: %s.  Use -h for help." % options.format)
+def option_parser ():
+    parser = OptionParser ()
+    parser.set_defaults (rules_dir='', format='text', dest_dir='processed', pattern='*.xml', verbosity='warn', root_element='//directive', fname_attribute='name', src_dir='src', jobs=1, incremental=False, manifest=None, cache_dtd=False, validation_cache=None, stream=False, profile=False, profile_json=None, rules_cache=True, watch=False, interval=1.0, serve=None, bundle=None, memoize=False, writers=2)
+    parser.add_option ("-s", "--source", dest="src_dir", help="source directory for XML files", metavar="SRC")
+    parser.add_option ("-d", "--destination", dest="dest_dir", help="destination directory", metavar="DIR")
+    parser.add_option ("-p", "--pattern", dest="pattern", help="convert files matching pattern", metavar="PATTERN")
+    parser.add_option ("-r", "--root", dest="root_element", help="the root element, files will be split at every one of these", metavar="ROOT")
+    parser.add_option ("-a", "--attribute", dest="fname_attribute", help="files will be named for this attribute of the ROOT element", metavar="ATTR")
+    parser.add_option ("-f", "--format", dest="format", help="output format [{0}], several may be given separated by commas".format ('|'.join (available_formats)), metavar="FORMAT")
+    parser.add_option ("-v", "--verbosity", dest="verbosity", help="set verbosity [{0}]".format ('|'.join (verbosity_levels)), metavar="LEVEL")
+    parser.add_option ("-b", "--bundle", dest="bundle", help="store the fragments in the SQLite database FILE instead of files below DIR", metavar="FILE")
+    parser.add_option ("-i", "--incremental", dest="incremental", action="store_true", help="only convert files changed since the last incremental run, removing orphaned fragments")
+    parser.add_option ("-m", "--manifest", dest="manifest", help="manifest for --incremental [DIR/.FORMAT[+FORMAT...].manifest]", metavar="FILE")
+    parser.add_option ("--cache-dtd", dest="cache_dtd", action="store_true", help="load each DTD once and validate parsed sources against it")
+    parser.add_option ("--validation-cache", dest="validation_cache", help="skip validating sources unchanged since they last validated, implies --cache-dtd", metavar="FILE")
+    parser.add_option ("--no-rules-cache", dest="rules_cache", action="store_false", help="always parse the rules files instead of loading them from .FORMAT.rules.cache")
+    parser.add_option ("--memoize", dest="memoize", action="store_true", help="render identical subtrees of rules declaring pure = True once")
+    parser.add_option ("--stream", dest="stream", action="store_true", help="convert each ROOT element as soon as it has been read, keeping memory use bounded on large sources")
+    parser.add_option ("--profile", dest="profile", action="store_true", help="print the time spent in each rule, its lookup, code and directives, and the XPaths no rule matched")
+    parser.add_option ("--profile-json", dest="profile_json", help="also write the --profile report to FILE as JSON, implies --profile", metavar="FILE")
+    parser.add_option ("-w", "--watch", dest="watch", action="store_true", help="keep running, converting sources as they or the rules files change")
+    parser.add_option ("--interval", dest="interval", help="seconds between checks for changes in --watch mode [1.0]", metavar="SECONDS", type=float)
+    parser.add_option ("--serve", dest="serve", help="serve render requests over HTTP on [HOST:]PORT, HOST defaulting to 127.0.0.1, implies --watch", metavar="ADDR")
+    parser.add_option ("--writers", dest="writers", help="write fragments from N background threads, 0 to write each before rendering goes on [2]", metavar="N", type=int)
+    parser.add_option ("-j", "--jobs", dest="jobs", help="convert N files at once, 0 for one per CPU", metavar="N", type=int)
+    return parser
 
-try:
-    options.verbosity = verbosity_levels [options.verbosity]
-except KeyError:
-    parser.error ("Invalid verbosity level")
 
+def main ():
+    parser = option_parser ()
+    (options, args) = parser.parse_args ()
 
-logger = logging.getLogger (__name__)
-logger.setLevel (options.verbosity)
+    options.formats = options.format.split (',')
+    for format in options.formats:
+        if format not in available_formats:
+            parser.error ("Invalid output format: %s.  Use -h for help." % format)
 
-rules = RulesParser ()
-rules.parse (file ('%s.rules' % options.format))
+    try:
+        options.verbosity = verbosity_levels [options.verbosity]
+    except KeyError:
+        parser.error ("Invalid verbosity level")
 
-parser = etree.XMLParser (dtd_validation=True)
-processor = Transformer (rules)
-logger.info (processor.description ())
+    options.profile = options.profile or bool (options.profile_json)
 
-# for each xml file
-for root, folders, files in os.walk (options.src_dir):
-    for filename in files:
-        if not fnmatch (filename, options.pattern):
-            continue
-        processor.set_srcfile (os.path.join (root.replace (options.src_dir, ''), filename))
-        srcfile = os.path.join (root, filename)
-        tree = etree.parse (srcfile, parser)
-        logger.debug ("  processing: {0}".format (os.path.basename (srcfile)))
+    if options.stream:
+        if root_matcher (options.root_element) is None:
+            parser.error ("--stream only supports a ROOT of the form //TAG or /PATH/TO/TAG")
+        if options.cache_dtd or options.validation_cache:
+            parser.error ("--stream validates while parsing and can't be combined with --cache-dtd or --validation-cache")
 
-        # for each element, in its own output file
-        for directive in tree.xpath (options.root_element):
-            processor.set_root (directive)
-            output = StringIO ()
+    if options.jobs < 0:
+        parser.error ("Invalid number of jobs: %d" % options.jobs)
 
-            # process element's tree
-            for event, element in etree.iterwalk (directive, events=('start', 'end')):
-                t = processor.process_element (event, element)
-                if t is not None:
-                    try:
-                        output.write (t)
-                    except UnicodeError, e:
-                        print (u"\n\nUnicode error processing the following text:\n{0}\n\n".format (t), file=sys.stderr)
-                        raise
+    if options.writers < 0:
+        parser.error ("Invalid number of writers: %d" % options.writers)
 
-                if processor._newfile:
-                    target_dir = os.path.join (options.dest_dir, processor.directory (), root.replace (options.src_dir, ''), os.path.splitext (os.path.basename (srcfile))[0])
-                    output_file = '{0}.{1}'.format (os.path.join (target_dir, element.get (options.fname_attribute)), processor.extension ())
-                    logger.debug ("      -> {0}".format (output_file))
+    if options.bundle and options.incremental:
+        parser.error ("--bundle can't be combined with --incremental")
 
-                    # mkdir -p
-                    try:
-                        os.makedirs (target_dir)
-                    except OSError, e:
-                        if e.errno != errno.EEXIST:
-                            raise
-
-                    # write output file
-                    fragment = file (output_file, 'w')
-                    fragment.write (output.getvalue ().encode ('utf-8'))
-                    fragment.close ()
-
-                    output = StringIO ()
-                    processor._newfile = False
+    options.watch = options.watch or bool (options.serve)
+    if options.watch:
+        if options.stream or options.incremental or options.bundle or options.jobs != 1:
+            parser.error ("--watch can't be combined with --stream, --incremental, --bundle or --jobs")
+        if options.serve and not options.serve.rpartition (':')[2].isdigit ():
+            parser.error ("Invalid address for --serve: %s" % options.serve)
+        # keep the DTDs loaded between conversions
+        options.cache_dtd = True
+
+    logger = logging.getLogger (__name__)
+    logger.setLevel (options.verbosity)
+
+    start = time.time ()
+    processors, validator = load (options)
+    if options.profile:
+        for processor in processors:
+            processor.profile = Profile ()
+    targets = {}
+    for format, processor in zip (options.formats, processors):
+        logger.info (processor.description ())
+        logger.info ("rules ({0}): {1} in {2:.3f}s".format (
+            format, 'loaded from cache' if processor._cfg.cached else 'parsed', processor._cfg.load_time
+        ))
+        target = (processor.directory (), processor.extension ())
+        if target in targets:
+            logger.warn ("{0} and {1} both write {2}/*.{3}, {1} will overwrite {0}".format (targets [target], format, *target))
+        targets.setdefault (target, format)
+
+    # fragments are written in the background from here on (by the workers'
+    # own writers with --jobs), and all of them before doc2.py exits, whether
+    # it succeeds or not
+    if options.jobs == 1:
+        start_writer (options)
+    try:
+        if options.watch:
+            return watch (options, processors, validator)
+
+        jobs = []
+        for root, folders, files in os.walk (options.src_dir):
+            for filename in files:
+                if fnmatch (filename, options.pattern):
+                    jobs.append ((root, filename))
+
+        if options.bundle:
+            # the bundle is only committed if every source converts
+            bundle = Bundle (options.bundle)
+            for job, fragments in convert_all (processors, validator, options, jobs):
+                store_bundled (bundle)
+            for path in bundle.remove_unstored ():
+                logger.debug ("      removed {0}".format (path))
+                fragment_stats ['removed'] += 1
+            bundle.close ()
+        elif not options.incremental:
+            for job, fragments in convert_all (processors, validator, options, jobs):
+                pass
+        else:
+            rules_files = [rules_file (options, format) for format in options.formats]
+            manifest = Manifest (
+                options.manifest or os.path.join (options.dest_dir, '.{0}.manifest'.format ('+'.join (options.formats))),
+                options.dest_dir, ','.join (digest (f) for f in rules_files), (options.root_element, options.fname_attribute),
+                options.formats
+            )
+            if not manifest.valid:
+                logger.info ("incremental: no usable manifest for {0}, converting everything".format (', '.join (rules_files)))
+
+            changed = OrderedDict ()    # (root, filename) -> (source, hash)
+            for root, filename in jobs:
+                source = os.path.join (root.replace (options.src_dir, ''), filename)
+                hash = digest (os.path.join (root, filename))
+                if manifest.fresh (source, hash):
+                    manifest.keep (source)
+                else:
+                    changed [root, filename] = (source, hash)
+
+            converted = [(job, fragments) for job, fragments in convert_all (processors, validator, options, changed.keys ())]
+
+            # fragments are recorded with their hash, and orphans removed,
+            # once every fragment is on disk
+            flush_writer ()
+            for job, fragments in converted:
+                source, hash = changed [job]
+                manifest.record (source, hash, fragments)
+            for fragment in manifest.remove_orphans ():
+                logger.debug ("      removed {0}".format (fragment))
+                fragment_stats ['removed'] += 1
+            manifest.save ()
+            logger.info ("incremental: {0} converted, {1} unchanged".format (len (changed), len (jobs) - len (changed)))
+    finally:
+        stop_writer ()
+
+    validator.save ()
+    wall = time.time () - start
+    if validator.cache_dtd:
+        logger.info ("timing: {0:.2f}s wall, {1:.2f}s parsing, {2:.2f}s validating ({3:.0%} of wall time), {4} validations skipped".format (
+            wall, validator.parse_time, validator.validate_time, validator.validate_time / wall if wall else 0, validator.skipped
+        ))
+    else:
+        logger.info ("timing: {0:.2f}s wall, {1:.2f}s parsing and validating ({2:.0%} of wall time)".format (
+            wall, validator.parse_time, validator.parse_time / wall if wall else 0
+        ))
+
+    logger.info ("fragments: {written} written, {unchanged} unchanged, {removed} removed".format (**fragment_stats))
+    logger.info ("pruning: {pruned} subtrees pruned".format (**walk_stats))
+
+    for format, processor in zip (options.formats, processors):
+        cache = processor._cfg.cache
+        logger.info ("rule cache ({0}): {1} hits, {2} misses".format (format, cache.hits, cache.misses))
+        if processor.memo is not None:
+            logger.info ("memo ({0}): {hits} hits, {misses} misses, {uncacheable} uncacheable".format (format, **processor.memo_stats))
+
+    if options.profile:
+        for format, processor in zip (options.formats, processors):
+            processor.profile.print_table (format)
+        if options.profile_json:
+            dump_profiles (dict ((f, p.profile) for f, p in zip (options.formats, processors)), options.profile_json)
+
+
+if __name__ == '__main__':
+    main ()
@@ -0,0 +1,139 @@
+# --------------------------------------------------------------------------
+# manifest.py
+#
+# Bookkeeping for doc2.py's incremental mode.  A manifest records, for each
+# source file, a hash of its contents, the formats it was converted to and
+# the fragments converting it produced with a hash of each, along with a
+# hash of the rules and settings used.
+# --------------------------------------------------------------------------
+
+import os, errno
+import hashlib
+import json
+
+MANIFEST_VERSION = 2
+
+
+def digest (filename):
+    ''' sha1 of a file's contents
+    '''
+    h = hashlib.sha1 ()
+    with open (filename, 'rb') as f:
+        for block in iter (lambda: f.read (65536), b''):
+            h.update (block)
+    return h.hexdigest ()
+
+
+def remove (fragments, dest_dir):
+    ''' delete fragments along with any directories below dest_dir they
+        leave empty, returning the fragments removed
+    '''
+    removed = []
+    for fragment in fragments:
+        try:
+            os.remove (fragment)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            continue
+        removed.append (fragment)
+
+        directory = os.path.dirname (fragment)
+        while os.path.abspath (directory) != os.path.abspath (dest_dir):
+            try:
+                os.rmdir (directory)
+            except OSError:
+                break
+            directory = os.path.dirname (directory)
+    return removed
+
+
+class Manifest (object):
+    def __init__ (self, filename, dest_dir, rules_hash, settings=(), formats=()):
+        self.filename = filename
+        self.dest_dir = dest_dir
+        self.rules_hash = rules_hash
+        self.settings = list (settings)
+        self.formats = list (formats)
+        self.previous = {}           # source -> entry, as loaded from disk
+        self.current = {}            # source -> entry, for this run
+        self.valid = False           # previous entries may be reused
+
+        try:
+            with open (filename) as f:
+                state = json.load (f)
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+        except ValueError:
+            return
+
+        # a different rules file, [defines] included, or settings invalidate
+        # every entry, but their fragments are still needed to find orphans
+        self.previous = state.get ('sources', {})
+        self.valid = (
+            state.get ('version') == MANIFEST_VERSION and
+            state.get ('rules') == rules_hash and state.get ('settings') == self.settings
+        )
+
+    def fresh (self, source, hash):
+        ''' True if source converted with the same contents, rules and
+            formats last time and all of its fragments are still present as
+            written then.  Formats sharing an output directory and extension
+            write the same files, so another format may have overwritten them.
+        '''
+        entry = self.previous.get (source)
+        if not self.valid or entry is None or entry ['hash'] != hash or entry ['formats'] != self.formats:
+            return False
+        for f, fragment_hash in entry ['fragments'].items ():
+            try:
+                if digest (os.path.join (self.dest_dir, f)) != fragment_hash:
+                    return False
+            except IOError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                return False
+        return True
+
+    def keep (self, source):
+        self.current [source] = self.previous [source]
+
+    def record (self, source, hash, fragments):
+        ''' record the fragments converting source produced, which must be
+            on disk
+        '''
+        self.current [source] = dict (
+            hash = hash,
+            formats = self.formats,
+            fragments = dict ((os.path.relpath (f, self.dest_dir), digest (f)) for f in fragments)
+        )
+
+    def orphans (self):
+        ''' fragments produced last time that no source produces now
+        '''
+        produced = set ()
+        for entry in self.current.values ():
+            produced.update (entry ['fragments'])
+        orphans = set ()
+        for entry in self.previous.values ():
+            orphans.update (f for f in entry ['fragments'] if f not in produced)
+        return sorted (os.path.join (self.dest_dir, f) for f in orphans)
+
+    def remove_orphans (self):
+        ''' delete orphaned fragments along with any directories they leave
+            empty, returning the fragments removed
+        '''
+        return remove (self.orphans (), self.dest_dir)
+
+    def save (self):
+        state = dict (version=MANIFEST_VERSION, rules=self.rules_hash, settings=self.settings, sources=self.current)
+        try:
+            os.makedirs (os.path.dirname (self.filename))
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        tmp = self.filename + '.tmp'
+        with open (tmp, 'w') as f:
+            json.dump (state, f, indent=1, sort_keys=True)
+        os.rename (tmp, self.filename)
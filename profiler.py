@@ -0,0 +1,110 @@
+# --------------------------------------------------------------------------
+# profiler.py
+#
+# Per-rule profiling for doc2.py's --profile option.  For every (rule, event)
+# a Profile counts the events handled and accumulates the wall time spent
+# looking the rule up, executing its code block and in each dd_* directive.
+# XPaths no rule matched are counted separately.
+# --------------------------------------------------------------------------
+
+from __future__ import print_function
+import sys
+import json
+from timeit import default_timer as clock
+
+
+class Profile (object):
+    def __init__ (self):
+        self.rules = {}              # (rule, event) -> [calls, lookup, exec, {directive: [calls, seconds]}]
+        self.unmatched = {}          # xpath -> [count, lookup]
+
+    def entry (self, rule, event):
+        try:
+            return self.rules [rule, event]
+        except KeyError:
+            entry = self.rules [rule, event] = [0, 0.0, 0.0, {}]
+            return entry
+
+    def miss (self, xpath, lookup):
+        entry = self.unmatched.setdefault (xpath, [0, 0.0])
+        entry [0] += 1
+        entry [1] += lookup
+
+    def merge (self, other):
+        ''' add the counts of another Profile (or its state ()) to this one
+        '''
+        rules, unmatched = other if isinstance (other, tuple) else other.state ()
+        for key, (calls, lookup, exec_, directives) in rules.items ():
+            entry = self.entry (*key)
+            entry [0] += calls
+            entry [1] += lookup
+            entry [2] += exec_
+            for name, (n, seconds) in directives.items ():
+                d = entry [3].setdefault (name, [0, 0.0])
+                d [0] += n
+                d [1] += seconds
+        for xpath, (count, lookup) in unmatched.items ():
+            entry = self.unmatched.setdefault (xpath, [0, 0.0])
+            entry [0] += count
+            entry [1] += lookup
+
+    def state (self):
+        return self.rules, self.unmatched
+
+    def drain (self):
+        ''' return and reset the counts so far, for merge () elsewhere
+        '''
+        state = self.state ()
+        self.rules, self.unmatched = {}, {}
+        return state
+
+    def report (self):
+        ''' a JSON-serializable summary, rules sorted by total time
+        '''
+        rules = []
+        for (rule, event), (calls, lookup, exec_, directives) in self.rules.items ():
+            directive_time = sum (seconds for n, seconds in directives.values ())
+            rules.append ({
+                'rule': rule,
+                'event': event,
+                'calls': calls,
+                'lookup': lookup,
+                'exec': exec_,
+                'directives': dict ((name, dict (calls=n, seconds=seconds)) for name, (n, seconds) in directives.items ()),
+                'total': lookup + exec_ + directive_time
+            })
+        rules.sort (key=lambda r: (-r ['total'], r ['rule'], r ['event']))
+
+        unmatched = [
+            dict (xpath=xpath, count=count, lookup=lookup)
+            for xpath, (count, lookup) in self.unmatched.items ()
+        ]
+        unmatched.sort (key=lambda u: (-u ['count'], u ['xpath']))
+
+        return dict (
+            rules = rules,
+            unmatched = unmatched,
+            total = sum (r ['total'] for r in rules) + sum (u ['lookup'] for u in unmatched)
+        )
+
+    def print_table (self, title, file=sys.stderr):
+        report = self.report ()
+        print ("\n{0}: {1:.3f}s in rules\n".format (title, report ['total']), file=file)
+        print ("{0:>8} {1:>9} {2:>9} {3:>9} {4:>9}  {5:<5}  {6}".format ('calls', 'total', 'lookup', 'exec', 'directive', 'event', 'rule'), file=file)
+        for r in report ['rules']:
+            print ("{calls:>8} {total:>9.4f} {lookup:>9.4f} {exec:>9.4f} {0:>9.4f}  {event:<5}  {rule}".format (
+                r ['total'] - r ['lookup'] - r ['exec'], **r
+            ), file=file)
+            for name, d in sorted (r ['directives'].items (), key=lambda item: -item [1]['seconds']):
+                print ("{0:>8} {1:>9.4f} {2:>9} {3:>9} {4:>9}         dd_{5}".format (d ['calls'], d ['seconds'], '', '', '', name), file=file)
+
+        if report ['unmatched']:
+            print ("\n{0:>8} {1:>9}  unmatched xpath".format ('count', 'lookup'), file=file)
+            for u in report ['unmatched']:
+                print ("{count:>8} {lookup:>9.4f}  {xpath}".format (**u), file=file)
+
+def dump (profiles, filename):
+    ''' write the reports of a {format: Profile} mapping as JSON
+    '''
+    with open (filename, 'w') as f:
+        json.dump (dict ((format, p.report ()) for format, p in profiles.items ()), f, indent=1, sort_keys=True)
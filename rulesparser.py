@@ -7,28 +7,262 @@
 # --------------------------------------------------------------------------
 
 from __future__ import print_function
-import sys
+import os, sys, errno
 import logging
 import string
 import re
+import ast
+import time
+import marshal
+import hashlib
 import traceback
 try:
     from collections import OrderedDict
 except ImportError:
     from ordereddict import OrderedDict
-from pyparsing import (
-    Literal, Word, White, ZeroOrMore, OneOrMore,
-    Group, Dict, Optional, printables, ParseException, restOfLine
-)
 
 def tokens2dict (tokens):
     return OrderedDict ([(t [0], t [1:]) for t in tokens])
 
+# a rule regex of the form  .../name$  .../(name|name)(\[\d+\])?$  etc.
+suffix_re = re.compile (r'''
+    /(?:
+        (?P<name>[\w-]+)
+      | \((?:\?P<\w+>)?(?P<names>[\w-]+(?:\|[\w-]+)*)\)
+    )
+    (?:\(\\\[(?:\\d\+|\d+)\\\]\)\?)?
+    \$$
+''', re.X)
+
+def suffix_tags (regex):
+    ''' return the set of element names that can end an XPath matched by
+        regex, or None if the regex can match any element
+    '''
+    mo = suffix_re.search (regex)
+    if not mo or '(?' in regex [:mo.start ()].replace ('(?P<', '').replace ('(?:', ''):
+        return None
+
+    # a top-level alternation in front of the suffix makes it optional
+    depth, escaped, inclass = 0, False, False
+    for c in regex [:mo.start ()]:
+        if escaped: escaped = False
+        elif c == '\\': escaped = True
+        elif inclass: inclass = c != ']'
+        elif c == '[': inclass = True
+        elif c == '(': depth += 1
+        elif c == ')': depth -= 1
+        elif c == '|' and depth == 0: return None
+
+    if mo.group ('name'):
+        return frozenset ([mo.group ('name')])
+    return frozenset (mo.group ('names').split ('|'))
+
+def xpath_tag (xpath):
+    ''' the element name of the last step of an XPath
+    '''
+    return xpath.rsplit ('/', 1)[-1].split ('[', 1)[0]
+
+# the names a rule's code block is evaluated with, see Transformer
+RULE_ARGS = (
+    're', 'string', 'os', 'event', 'elem', 'last_output',
+    'match', 'regex', 'xpath', 'filename', 'globals'
+)
+
+def constant (node):
+    ''' the value of an AST node if it is an immutable literal, else raise
+        ValueError
+    '''
+    value = ast.literal_eval (node)
+    if isinstance (value, tuple):
+        for v in value:
+            if not isinstance (v, (basestring, int, long, float, complex, bool, type (None), tuple)):
+                raise ValueError (v)
+    elif not isinstance (value, (basestring, int, long, float, complex, bool, type (None))):
+        raise ValueError (value)
+    return value
+
+def static_settings (tree):
+    ''' if a code block only assigns literals to plain names, return those
+        assignments in order, else None
+    '''
+    settings = OrderedDict ()
+    for stmt in tree.body:
+        if not isinstance (stmt, ast.Assign) or len (stmt.targets) != 1 or not isinstance (stmt.targets [0], ast.Name):
+            return None
+        try:
+            settings [stmt.targets [0].id] = constant (stmt.value)
+        except ValueError:
+            return None
+    return settings
+
+def reads_before_assigning (tree):
+    ''' whether a code block reads a variable it also assigns before
+        assigning it.  exec () looks such a read up in the globals, a
+        function body would raise UnboundLocalError.
+    '''
+    stored = set (
+        node.id for node in ast.walk (tree)
+        if isinstance (node, ast.Name) and not isinstance (node.ctx, (ast.Load, ast.Param))
+    ) - set (RULE_ARGS)
+    assigned = set ()
+    for stmt in tree.body:
+        if isinstance (stmt, ast.AugAssign) and isinstance (stmt.target, ast.Name) and stmt.target.id not in assigned:
+            return True
+        for node in ast.walk (stmt):
+            if isinstance (node, ast.Name) and isinstance (node.ctx, ast.Load) and node.id in stored and node.id not in assigned:
+                return True
+        if isinstance (stmt, ast.Assign):
+            for target in stmt.targets:
+                assigned.update (node.id for node in ast.walk (target) if isinstance (node, ast.Name))
+    return False
+
+def function_code (tree, filename):
+    ''' compile a code block as the body of a function taking RULE_ARGS and
+        returning its locals (), keeping the block's line numbers.  Returns
+        None if the block can't be a function body, or would behave
+        differently as one.
+    '''
+    if reads_before_assigning (tree):
+        return None
+    body = tree.body + [
+        ast.Return (value=ast.Call (func=ast.Name (id='locals', ctx=ast.Load ()), args=[], keywords=[], starargs=None, kwargs=None))
+    ]
+    func = ast.FunctionDef (
+        name = 'rule',
+        args = ast.arguments (args=[ast.Name (id=a, ctx=ast.Param ()) for a in RULE_ARGS], vararg=None, kwarg=None, defaults=[]),
+        body = body,
+        decorator_list = []
+    )
+    module = ast.fix_missing_locations (ast.Module (body=[func]))
+    try:
+        return compile (module, filename, 'exec')
+    except SyntaxError:
+        return None
+
+###
+# Compiled rules are cached next to the rules file, keyed by a hash of its
+# contents and the Python version (marshal and bytecode formats vary)
+###
+CACHE_VERSION = 2
+
+def cache_file (filename):
+    ''' the default cache of a rules file, foo/bar.rules -> foo/.bar.rules.cache
+    '''
+    head, tail = os.path.split (filename)
+    return os.path.join (head, '.{0}.cache'.format (tail))
+
+def cache_key (text):
+    return hashlib.sha1 ('{0}\n{1}\n'.format (CACHE_VERSION, sys.version) + text).hexdigest ()
+
+###
+# The rules file grammar
+###
+_grammar = []
+
+def grammar ():
+    ''' build the pyparsing grammar for rules files on first use.  pyparsing
+        is imported here rather than at module level so that loading rules
+        from the cache never imports it.
+    '''
+    if _grammar:
+        return _grammar [0]
+
+    from pyparsing import (
+        Literal, Word, White, ZeroOrMore, OneOrMore,
+        Group, Dict, Optional, printables, restOfLine
+    )
+
+    lbracket = Literal ("[").suppress ()
+    rbracket = Literal ("]").suppress ()
+    tilde  = Literal ("~").suppress ()
+    equals = Literal ("=").suppress ()
+    colon  = Literal (":").suppress ()
+    pound  = Literal ("#")
+    semi = Literal (';')
+    startEvent = Literal ('start')
+    endEvent = Literal ('end')
+
+    comment  = (pound ^ semi) + Optional (restOfLine)
+    nonequals = "".join ([ c for c in printables if c != "=" ]) + " \t"
+    noncolon  = "".join ([ c for c in printables if c != ":" ]) + " \t"
+    nonbracket = "".join ([ c for c in printables if c not in ['[',']'] ]) + " \t"
+
+    sectionDef = lbracket + Word (nonbracket) + rbracket
+    keyDef = ~tilde + Word (printables) + ZeroOrMore (Literal(' ')).suppress () + equals + ZeroOrMore (Literal (' ')).suppress () + restOfLine
+    eventDef = Word (noncolon) + colon
+    regexDef = tilde + ZeroOrMore (White (' \t').suppress ()) + restOfLine
+
+    keyBlock = Group (keyDef)
+    eventBlock = Group (eventDef + ZeroOrMore (keyBlock))
+    regexBlock = Group (regexDef + ZeroOrMore (eventBlock))
+    sectionBlock = Group (sectionDef + (ZeroOrMore (regexBlock) ^ ZeroOrMore (keyBlock)))
+
+    bnf = Dict (OneOrMore (sectionBlock))
+    bnf.ignore (comment)
+    _grammar.append (bnf)
+    return bnf
+
+###
+# A bounded mapping that discards the least recently used entries
+###
+class LRUCache (object):
+    ''' a circular doubly linked list threaded through a dict, the same
+        scheme as Python 3's functools.lru_cache (OrderedDict reordering
+        is too slow on Python 2 for a per-element cache)
+    '''
+    def __init__ (self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.clear ()
+
+    def clear (self):
+        self._links = {}
+        self._root = []
+        self._root [:] = [self._root, self._root, None, None]
+
+    def __len__ (self):
+        return len (self._links)
+
+    def get (self, key, default=None):
+        link = self._links.get (key)
+        if link is None:
+            self.misses += 1
+            return default
+
+        # move to the most recently used end
+        prev, next, _, value = link
+        prev [1] = next
+        next [0] = prev
+        last = self._root [0]
+        last [1] = self._root [0] = link
+        link [0] = last
+        link [1] = self._root
+        self.hits += 1
+        return value
+
+    def put (self, key, value):
+        if not self.size or key in self._links:
+            return
+        if len (self._links) >= self.size:
+            # drop the least recently used entry
+            oldest = self._root [1]
+            self._root [1] = oldest [1]
+            oldest [1][0] = self._root
+            del self._links [oldest [2]]
+        last = self._root [0]
+        link = [last, self._root, key, value]
+        last [1] = self._root [0] = self._links [key] = link
+
 ###
 # Parse a rules file
 ###
 class RulesParser (object):
-    def __init__ (self):
+    def __init__ (self, cache_size=4096):
+        self.cache = LRUCache (cache_size)   # XPath -> (regex, match), 0 disables
+        self.cached = False                  # load () used the rules cache
+        self.load_time = None                # seconds load () took
+
         self.processors = dict (
             defaults = self.__process_rules,
             rules = self.__process_rules,
@@ -36,34 +270,6 @@ class RulesParser (object):
             defines = self.__process_section
         )
 
-        lbracket = Literal ("[").suppress ()
-        rbracket = Literal ("]").suppress ()
-        tilde  = Literal ("~").suppress ()
-        equals = Literal ("=").suppress ()
-        colon  = Literal (":").suppress ()
-        pound  = Literal ("#")
-        semi = Literal (';')
-        startEvent = Literal ('start')
-        endEvent = Literal ('end')
-
-        comment  = (pound ^ semi) + Optional (restOfLine)
-        nonequals = "".join ([ c for c in printables if c != "=" ]) + " \t"
-        noncolon  = "".join ([ c for c in printables if c != ":" ]) + " \t"
-        nonbracket = "".join ([ c for c in printables if c not in ['[',']'] ]) + " \t"
-
-        sectionDef = lbracket + Word (nonbracket) + rbracket
-        keyDef = ~tilde + Word (printables) + ZeroOrMore (Literal(' ')).suppress () + equals + ZeroOrMore (Literal (' ')).suppress () + restOfLine
-        eventDef = Word (noncolon) + colon
-        regexDef = tilde + ZeroOrMore (White (' \t').suppress ()) + restOfLine
-
-        keyBlock = Group (keyDef)
-        eventBlock = Group (eventDef + ZeroOrMore (keyBlock))
-        regexBlock = Group (regexDef + ZeroOrMore (eventBlock))
-        sectionBlock = Group (sectionDef + (ZeroOrMore (regexBlock) ^ ZeroOrMore (keyBlock)))
-
-        self.bnf = Dict (OneOrMore (sectionBlock))
-        self.bnf.ignore (comment)
-
     def __process_rules (self, rules):
         config = OrderedDict ()
         for rule in rules:
@@ -83,6 +289,7 @@ class RulesParser (object):
                 for k, v in keys.items ():
                     config [regex][e][k] = v
                 config [regex][e]['.src'] = '\n'.join (["{0} = {1}".format (k, v) for (k, v) in config [regex][e].items ()])
+                config [regex][e]['.directives'] = tuple (keys)
 
         return config
 
@@ -117,11 +324,37 @@ class RulesParser (object):
                         print ("\nSyntaxError line {0}, char {1}\n".format (exc.lineno, exc.offset), file=sys.stderr)
                         sys.exit (1)
 
+                    # blocks of constant assignments need no evaluation at
+                    # all, anything else is cheaper to run as a function
+                    tree = ast.parse (code)
+                    keyblock ['.static'] = static_settings (tree)
+                    keyblock ['.func'] = None
+                    if keyblock ['.static'] is None:
+                        keyblock ['.func'] = function_code (tree, "{0} {1}".format (rule, e))
+
+    def __dispatch (self, config):
+        ''' index the rules by the element names their XPaths can end with.
+            Each index entry keeps the rules in file order, so the first
+            matching candidate is also the first matching rule.
+        '''
+        rules = [
+            (regex, rule ['.re'], suffix_tags (regex))
+            for regex, rule in config.get ('rules', {}).items ()
+        ]
+        tags = set ()
+        for _, _, t in rules:
+            tags.update (t or ())
+
+        self._wildcard = tuple ((regex, rx) for regex, rx, t in rules if t is None)
+        self._dispatch = dict (
+            (tag, tuple ((regex, rx) for regex, rx, t in rules if t is None or tag in t))
+            for tag in tags
+        )
 
     def parse (self, config):
         if type (config) != type (""):
             config = config.read ()
-        tokens = self.bnf.parseString (config)
+        tokens = grammar ().parseString (config)
         struct = tokens2dict (tokens.asList ())
         config = OrderedDict ()
 
@@ -132,9 +365,97 @@ class RulesParser (object):
             config [section] = self.processors [section] (struct [section])
 
         self.__compile (config)
+        self.__install (config)
+        return config
+
+    def __install (self, config):
+        self.__dispatch (config)
+        self.cache.clear ()
         self._config = config
+
+    def __dump (self, config):
+        ''' the parsed and compiled rules as plain lists, tuples and code
+            objects for marshal.  Rule order is kept, compiled regexes are
+            recompiled on load.
+        '''
+        sections = []
+        for section, body in config.items ():
+            if section not in ('rules', 'defaults'):
+                sections.append ((section, body.items ()))
+                continue
+            rules = []
+            for regex, rule in body.items ():
+                events = []
+                for e, keyblock in rule.items ():
+                    if e.startswith ('.'): continue
+                    static = keyblock ['.static']
+                    events.append ((
+                        e, [(k, v) for k, v in keyblock.items () if not k.startswith ('.')],
+                        keyblock ['.src'], keyblock ['.directives'], keyblock ['.obj'],
+                        static if static is None else static.items (), keyblock ['.func']
+                    ))
+                rules.append ((regex, events))
+            sections.append ((section, rules))
+        return sections
+
+    def __undump (self, sections):
+        config = OrderedDict ()
+        for section, body in sections:
+            if section not in ('rules', 'defaults'):
+                config [section] = OrderedDict (body)
+                continue
+            rules = config [section] = OrderedDict ()
+            for regex, events in body:
+                rule = rules [regex] = OrderedDict ()
+                rule ['.re'] = re.compile (regex)
+                for e, keys, src, directives, obj, static, func in events:
+                    keyblock = rule [e] = OrderedDict (keys)
+                    keyblock ['.src'] = src
+                    keyblock ['.directives'] = directives
+                    keyblock ['.obj'] = obj
+                    keyblock ['.static'] = static if static is None else OrderedDict (static)
+                    keyblock ['.func'] = func
         return config
 
+    def load (self, filename, cache=None):
+        ''' parse a rules file, or load its compiled rules from the cache
+            file if that was written for the same contents.  A missing or
+            stale cache is (re)written after parsing.  Sets cached and
+            load_time.
+        '''
+        start = time.time ()
+        with open (filename) as f:
+            text = f.read ()
+        key = cache_key (text)
+
+        self.cached = False
+        if cache:
+            try:
+                with open (cache, 'rb') as f:
+                    cached_key, sections = marshal.load (f)
+                if cached_key == key:
+                    self.__install (self.__undump (sections))
+                    self.cached = True
+            except IOError, e:
+                if e.errno != errno.ENOENT:
+                    logging.warn ("Ignoring rules cache {0}: {1}".format (cache, e))
+            except (ValueError, EOFError, TypeError):
+                logging.warn ("Ignoring corrupt rules cache {0}".format (cache))
+
+        if not self.cached:
+            config = self.parse (text)
+            if cache:
+                try:
+                    tmp = cache + '.tmp'
+                    with open (tmp, 'wb') as f:
+                        marshal.dump ((key, self.__dump (config)), f)
+                    os.rename (tmp, cache)
+                except (IOError, OSError, ValueError), e:
+                    logging.warn ("Can't write rules cache {0}: {1}".format (cache, e))
+
+        self.load_time = time.time () - start
+        return self._config
+
     def get (self, section):
         return self._config [section]
 
@@ -167,6 +488,17 @@ class RulesParser (object):
             if not k.startswith ('.')
         ])
 
+    def directives (self, rule, event):
+        ''' the names a rule's event assigns, in order.  Unlike settings (),
+            this is computed once at parse time.
+        '''
+        if event in self._config ['rules'][rule]:
+            return self._config ['rules'][rule][event]['.directives']
+        try:
+            return self._config ['defaults'].values ()[0][event]['.directives']
+        except KeyError:
+            return ()
+
     def src (self, rule, event):
         ''' for debugging
         '''
@@ -182,12 +514,45 @@ class RulesParser (object):
             logging.warn ("No handler found for {1} event in rule {0}, passing raw data.".format (rule, event))
             return compile ('pass', 'No default found', 'exec')
 
-    def search (self, pattern):
-        for regex in self.rules ():
-            mo = self._config ['rules'][regex]['.re'].search (pattern, re.M)
+    def block (self, rule, event):
+        ''' how to evaluate a rule's code block: a (static, func, obj) tuple
+            where static is the settings of a block of constant assignments
+            (or None), func code defining the block as a function taking
+            RULE_ARGS (or None) and obj the code object itself
+        '''
+        if event in self._config ['rules'][rule]:
+            keyblock = self._config ['rules'][rule][event]
+        else:
+            try:
+                keyblock = self._config ['defaults'].values ()[0][event]
+            except KeyError:
+                return OrderedDict (), None, self.obj (rule, event)
+        return keyblock ['.static'], keyblock ['.func'], keyblock ['.obj']
+
+    def candidates (self, pattern):
+        ''' the rules that may match pattern, in order
+        '''
+        return self._dispatch.get (xpath_tag (pattern), self._wildcard)
+
+    def lookup (self, pattern):
+        ''' find the first rule matching pattern, bypassing the cache
+        '''
+        for regex, rx in self.candidates (pattern):
+            mo = rx.search (pattern, re.M)
             if mo: return regex, mo
         return None, None
 
+    def search (self, pattern):
+        ''' find the first rule matching pattern.  Results are kept in a
+            bounded LRU cache since the same XPaths recur across events,
+            directives and files.
+        '''
+        result = self.cache.get (pattern)
+        if result is None:
+            result = self.lookup (pattern)
+            self.cache.put (pattern, result)
+        return result
+
 ###
 # do a quick test
 ###
@@ -0,0 +1,95 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# --------------------------------------------------------------------------
+# test_bundle.py
+#
+# bundle.Bundle's storage and lookups, and doc2.py --bundle storing the
+# fragments it would otherwise write as files.
+#
+# usage: python -m unittest discover -s tests
+# --------------------------------------------------------------------------
+
+import os, sys
+import shutil
+import subprocess
+import tempfile
+import unittest
+from glob import glob
+
+BASE_DIR = os.path.dirname (os.path.dirname (os.path.abspath (__file__)))
+sys.path.insert (0, BASE_DIR)
+sys.path.insert (0, os.path.join (BASE_DIR, 'benchmarks'))
+
+from corpus import generate
+from bundle import Bundle
+
+FRAGMENTS = [
+    ('rst/http/mod_a/one.rst', 'rst', 'mod_a', 'one', u'one'),
+    ('rst/http/mod_a/two.rst', 'rst', 'mod_a', 'two', u'two — 2'),
+    ('mediawiki/http/mod_a/one.txt', 'mediawiki', 'mod_a', 'one', u'== one =='),
+    ('rst/http/mod_b/three.rst', 'rst', 'mod_b', 'three', u'three'),
+]
+
+
+class BundleTest (unittest.TestCase):
+    def setUp (self):
+        self.tmp = tempfile.mkdtemp ()
+        self.filename = os.path.join (self.tmp, 'docs.db')
+
+    def tearDown (self):
+        shutil.rmtree (self.tmp)
+
+    def test_round_trip (self):
+        bundle = Bundle (self.filename)
+        self.assertEqual (bundle.put (FRAGMENTS), (4, 0))
+        bundle.close ()
+
+        bundle = Bundle (self.filename)
+        self.assertEqual (bundle.get ('mod_a', 'two', 'rst'), u'two — 2')
+        self.assertEqual (bundle.get ('mod_a', 'one', 'mediawiki'), u'== one ==')
+        self.assertIn (bundle.get ('mod_a', 'one'), (u'one', u'== one =='))
+        self.assertIsNone (bundle.get ('mod_a', 'three'))
+        self.assertEqual (bundle.names ('mod_a'), ['one', 'two'])
+        self.assertEqual (bundle.names ('mod_a', 'mediawiki'), ['one'])
+        self.assertEqual (bundle.modules (), ['mod_a', 'mod_b'])
+        self.assertEqual (bundle.modules ('mediawiki'), ['mod_a'])
+        bundle.close ()
+
+    def test_put_unchanged_and_remove_unstored (self):
+        bundle = Bundle (self.filename)
+        bundle.put (FRAGMENTS)
+        bundle.close ()
+
+        bundle = Bundle (self.filename)
+        changed = FRAGMENTS [0][:4] + (u'one, changed',)
+        self.assertEqual (bundle.put ([changed] + FRAGMENTS [1:3]), (1, 2))
+        self.assertEqual (bundle.remove_unstored (), ['rst/http/mod_b/three.rst'])
+        bundle.close ()
+
+        bundle = Bundle (self.filename)
+        self.assertEqual (bundle.get ('mod_a', 'one', 'rst'), u'one, changed')
+        self.assertEqual (bundle.modules (), ['mod_a'])
+        bundle.close ()
+
+    def test_doc2 (self):
+        src = os.path.join (self.tmp, 'src')
+        sources = generate (os.path.join (src, 'http'), modules=2, directives=3)
+        dest = os.path.join (self.tmp, 'out')
+        for args in ['-d', dest], ['-b', self.filename]:
+            subprocess.check_call ([sys.executable, 'doc2.py', '-s', src + os.sep, '-f', 'rst'] + args, cwd=BASE_DIR)
+
+        bundle = Bundle (self.filename)
+        modules = [os.path.splitext (os.path.basename (source))[0] for source in sources]
+        self.assertEqual (bundle.modules ('rst'), sorted (modules))
+        for module in modules:
+            files = glob (os.path.join (dest, 'rst', 'http', module, '*.rst'))
+            self.assertEqual (bundle.names (module, 'rst'), sorted (os.path.splitext (os.path.basename (f))[0] for f in files))
+            for filename in files:
+                with open (filename) as f:
+                    name = os.path.splitext (os.path.basename (filename))[0]
+                    self.assertEqual (bundle.get (module, name, 'rst'), f.read ().decode ('utf-8'))
+        bundle.close ()
+
+
+if __name__ == '__main__':
+    unittest.main ()
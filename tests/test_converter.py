@@ -0,0 +1,100 @@
+#!/usr/bin/python
+# --------------------------------------------------------------------------
+# test_converter.py
+#
+# doc2.Converter against doc2.py's own output, on a small corpus generated
+# by benchmarks/corpus.py below SRC/http.
+#
+# usage: python -m unittest discover -s tests
+# --------------------------------------------------------------------------
+
+import os, sys
+import shutil
+import subprocess
+import tempfile
+import threading
+import unittest
+from glob import glob
+
+BASE_DIR = os.path.dirname (os.path.dirname (os.path.abspath (__file__)))
+sys.path.insert (0, BASE_DIR)
+sys.path.insert (0, os.path.join (BASE_DIR, 'benchmarks'))
+
+from lxml import etree
+from corpus import generate
+import doc2
+
+
+class ConverterTest (unittest.TestCase):
+    def setUp (self):
+        self.tmp = tempfile.mkdtemp ()
+        self.src = os.path.join (self.tmp, 'src')
+        self.sources = generate (os.path.join (self.src, 'http'), modules=2, directives=3)
+
+    def tearDown (self):
+        shutil.rmtree (self.tmp)
+
+    def cli (self, format):
+        ''' {source: {name: text}} as doc2.py writes it
+        '''
+        dest = os.path.join (self.tmp, 'out')
+        subprocess.check_call (
+            [sys.executable, 'doc2.py', '-s', self.src + os.sep, '-d', dest, '-f', format, '--writers', '0'], cwd=BASE_DIR
+        )
+        fragments = {}
+        for source in self.sources:
+            module = os.path.splitext (os.path.basename (source))[0]
+            for filename in glob (os.path.join (dest, '*', 'http', module, '*')):
+                with open (filename) as f:
+                    name = os.path.splitext (os.path.basename (filename))[0]
+                    fragments.setdefault (source, {})[name] = f.read ().decode ('utf-8')
+        return fragments
+
+    def test_library_matches_cli (self):
+        expected = self.cli ('nginx-wiki')
+        converter = doc2.Converter (['nginx-wiki'], src_dir=self.src)
+        for path, formats in converter.convert_many (self.sources):
+            self.assertEqual (dict (formats ['nginx-wiki']), expected [path])
+        for path in self.sources:
+            with open (path) as f:
+                self.assertEqual (dict (converter.convert (f.read (), base_url=path)), expected [path])
+
+    def test_converters_in_threads (self):
+        expected = list (doc2.Converter (['rst', 'nginx-wiki'], src_dir=self.src).convert_many (self.sources * 3))
+        results = [None] * 4
+        def run (n):
+            converter = doc2.Converter (['rst', 'nginx-wiki'], src_dir=self.src)
+            results [n] = list (converter.convert_many (self.sources * 3))
+        threads = [threading.Thread (target=run, args=(n,)) for n in range (len (results))]
+        for thread in threads:
+            thread.start ()
+        for thread in threads:
+            thread.join ()
+        self.assertEqual (results, [expected] * len (results))
+
+    def test_string_without_doctype (self):
+        xml = etree.tostring (etree.parse (self.sources [0]).getroot ())
+        fragments = doc2.Converter ().convert (xml)
+        self.assertEqual (len (fragments), 3)
+
+    def test_invalid_string_with_validation_cache (self):
+        converter = doc2.Converter (validation_cache=os.path.join (self.tmp, 'validation.cache'))
+        path = self.sources [0]
+        with open (path) as f:
+            xml = f.read ()
+        list (converter.convert_many ([path]))
+        converter.convert (xml, base_url=path)
+        # the file at base_url validated, the string doesn't
+        invalid = xml.replace ('<context>', '<bogus/><context>', 1)
+        self.assertRaises (etree.DocumentInvalid, converter.convert, invalid, base_url=path)
+
+    def test_base_url_without_file (self):
+        with open (self.sources [0]) as f:
+            xml = f.read ()
+        base_url = os.path.join (self.src, 'http', 'elsewhere.xml')
+        fragments = doc2.Converter (validation_cache=os.path.join (self.tmp, 'validation.cache')).convert (xml, base_url=base_url)
+        self.assertEqual (len (fragments), 3)
+
+
+if __name__ == '__main__':
+    unittest.main ()
@@ -0,0 +1,74 @@
+#!/usr/bin/python
+# --------------------------------------------------------------------------
+# test_manifest.py
+#
+# manifest.Manifest: when a source converted last time is fresh, and which
+# of its fragments become orphans.
+#
+# usage: python -m unittest discover -s tests
+# --------------------------------------------------------------------------
+
+import os, sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert (0, os.path.dirname (os.path.dirname (os.path.abspath (__file__))))
+
+from manifest import Manifest
+
+
+class ManifestTest (unittest.TestCase):
+    def setUp (self):
+        self.tmp = tempfile.mkdtemp ()
+        self.filename = os.path.join (self.tmp, '.mediawiki.manifest')
+        self.fragments = [self.write ('mediawiki/http/a/one.txt', 'one'), self.write ('mediawiki/http/a/two.txt', 'two')]
+
+        manifest = self.manifest ()
+        manifest.record ('http/a.xml', 'hash', self.fragments)
+        manifest.save ()
+
+    def tearDown (self):
+        shutil.rmtree (self.tmp)
+
+    def write (self, name, text):
+        path = os.path.join (self.tmp, name)
+        if not os.path.isdir (os.path.dirname (path)):
+            os.makedirs (os.path.dirname (path))
+        with open (path, 'w') as f:
+            f.write (text)
+        return path
+
+    def manifest (self, formats=('mediawiki',), rules='rules'):
+        return Manifest (self.filename, self.tmp, rules, ('//directive', 'name'), formats)
+
+    def test_fresh (self):
+        manifest = self.manifest ()
+        self.assertTrue (manifest.fresh ('http/a.xml', 'hash'))
+        self.assertFalse (manifest.fresh ('http/a.xml', 'changed'))
+        self.assertFalse (manifest.fresh ('http/b.xml', 'hash'))
+
+    def test_other_rules (self):
+        self.assertFalse (self.manifest (rules='other').fresh ('http/a.xml', 'hash'))
+
+    def test_other_formats (self):
+        self.assertFalse (self.manifest (formats=('nginx-wiki',)).fresh ('http/a.xml', 'hash'))
+
+    def test_missing_fragment (self):
+        os.remove (self.fragments [1])
+        self.assertFalse (self.manifest ().fresh ('http/a.xml', 'hash'))
+
+    def test_overwritten_fragment (self):
+        # as another format writing to the same directory and extension does
+        self.write ('mediawiki/http/a/two.txt', 'other format')
+        self.assertFalse (self.manifest ().fresh ('http/a.xml', 'hash'))
+
+    def test_orphans (self):
+        manifest = self.manifest ()
+        manifest.record ('http/a.xml', 'changed', self.fragments [:1])
+        self.assertEqual (manifest.remove_orphans (), self.fragments [1:])
+        self.assertFalse (os.path.exists (self.fragments [1]))
+
+
+if __name__ == '__main__':
+    unittest.main ()
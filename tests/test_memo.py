@@ -0,0 +1,115 @@
+#!/usr/bin/python
+# --------------------------------------------------------------------------
+# test_memo.py
+#
+# Transformer.memoize (): identical pure subtrees are rendered once, and
+# rules reading state from outside the subtree are never cached.
+#
+# usage: python -m unittest discover -s tests
+# --------------------------------------------------------------------------
+
+import os, sys
+import unittest
+
+sys.path.insert (0, os.path.dirname (os.path.dirname (os.path.abspath (__file__))))
+
+from lxml import etree
+from rulesparser import RulesParser
+from doc2 import Transformer, convert_element, option_parser
+
+RULES = r'''
+[info]
+description = memo test
+extension = txt
+directory = test
+
+[defaults]
+~ ^
+    start:
+        sanitize = True
+    end:
+        sanitize = True
+
+[rules]
+~ /directive(\[\d+\])?$
+    start:
+        _name = globals.update (dname=elem.get ('name'))
+    end:
+        newfile = True
+
+~ /para(\[\d+\])?$
+    start:
+        pure = True
+        {para}
+
+~ .*
+    start:
+        sanitize = True
+'''
+
+
+def directives (count=3):
+    section = etree.SubElement (etree.Element ('module'), 'section')
+    for n in range (count):
+        directive = etree.SubElement (section, 'directive', name='d{0}'.format (n))
+        etree.SubElement (directive, 'para').text = 'same text'
+    return section
+
+def render (para, memoize):
+    ''' the fragments of three directives holding the same para, and the
+        memo's statistics
+    '''
+    rules = RulesParser ()
+    rules.parse (RULES.replace ('{para}', para))
+    processor = Transformer (rules)
+    if memoize:
+        processor.memoize ()
+    processor.set_srcfile ('test.xml')
+
+    options = option_parser ().get_default_values ()
+    fragments = []
+    def collect (processor, options, root, srcfile, element, text):
+        fragments.append (text)
+        return element.get ('name')
+    for directive in directives ():
+        convert_element ([processor], options, '', 'test.xml', directive, collect)
+    return fragments, processor.memo_stats
+
+
+class MemoTest (unittest.TestCase):
+    def check (self, para):
+        expected, _ = render (para, False)
+        fragments, stats = render (para, True)
+        self.assertEqual (fragments, expected)
+        return fragments, stats
+
+    def test_pure (self):
+        fragments, stats = self.check ('prefix = "> "')
+        self.assertEqual (fragments, ['> same text'] * 3)
+        self.assertEqual (stats ['hits'], 2)
+
+    def test_bare_global (self):
+        fragments, stats = self.check ('prefix = dname + ": "')
+        self.assertEqual (fragments, ['d0: same text', 'd1: same text', 'd2: same text'])
+        self.assertEqual (stats ['hits'], 0)
+
+    def test_global_read_before_assigning (self):
+        fragments, stats = self.check ('dname = dname + ": "\n        prefix = dname')
+        self.assertEqual (fragments, ['d0: same text', 'd1: same text', 'd2: same text'])
+        self.assertEqual (stats ['hits'], 0)
+
+    def test_globals (self):
+        _, stats = self.check ('prefix = globals ["dname"] + ": "')
+        self.assertEqual (stats ['hits'], 0)
+
+    def test_last_output (self):
+        _, stats = self.check ('prefix = last_output [-1:]')
+        self.assertEqual (stats ['hits'], 0)
+
+    def test_store (self):
+        _, stats = self.check ('store = "paras"')
+        self.assertEqual (stats ['hits'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main ()
@@ -0,0 +1,49 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# --------------------------------------------------------------------------
+# test_normalizer.py
+#
+# Normalizer.sanitize () with custom substitutions.
+#
+# usage: python -m unittest discover -s tests
+# --------------------------------------------------------------------------
+
+import os, sys
+import unittest
+
+sys.path.insert (0, os.path.dirname (os.path.dirname (os.path.abspath (__file__))))
+
+from doc2 import Normalizer
+
+
+class SanitizeTest (unittest.TestCase):
+    def test_defaults (self):
+        self.assertEqual (Normalizer ().sanitize (u'“quoted” — it’s'), u'"quoted" - it\'s')
+
+    def test_replacements_dont_chain (self):
+        # each character maps once, whatever the replacements are
+        self.assertEqual (Normalizer ({u'"': u"'"}).sanitize (u'“hi” "x"'), u'"hi" \'x\'')
+        self.assertEqual (Normalizer ({u'-': u'--'}).sanitize (u'a—b-c'), u'a-b--c')
+        self.assertEqual (Normalizer ({u'…': u'...', u'.': u'!'}).sanitize (u'a….'), u'a...!')
+
+    def test_delete (self):
+        self.assertEqual (Normalizer ({u'\xad': None}).sanitize (u'hy\xadphen'), u'hyphen')
+
+    def test_byte_strings (self):
+        normalizer = Normalizer ({u'|': u'/'})
+        self.assertEqual (normalizer.sanitize ('a|b'), 'a/b')
+        self.assertTrue (isinstance (normalizer.sanitize ('a|b'), str))
+
+    def test_ascii_to_non_ascii (self):
+        normalizer = Normalizer ({u'"': u'“'})
+        t = normalizer.sanitize ('say "hi')
+        self.assertEqual (t, u'say “hi')
+        self.assertTrue (isinstance (t, unicode))
+        # usable downstream like any other output
+        self.assertEqual ((t + u'!').encode ('utf-8'), 'say \xe2\x80\x9chi!')
+        # byte strings without anything to replace stay as they are
+        self.assertEqual (normalizer.sanitize ('plain'), 'plain')
+
+
+if __name__ == '__main__':
+    unittest.main ()
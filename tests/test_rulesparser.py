@@ -0,0 +1,95 @@
+#!/usr/bin/python
+# --------------------------------------------------------------------------
+# test_rulesparser.py
+#
+# Code blocks run as functions must leave the directives the same variables
+# as exec'ing them does.
+#
+# usage: python -m unittest discover -s tests
+# --------------------------------------------------------------------------
+
+import os, sys
+import ast
+import unittest
+
+sys.path.insert (0, os.path.dirname (os.path.dirname (os.path.abspath (__file__))))
+
+from lxml import etree
+from rulesparser import RulesParser, reads_before_assigning
+from doc2 import Transformer, convert_element, option_parser
+
+RULES = r'''
+[info]
+description = rule code test
+extension = txt
+directory = test
+
+[defaults]
+~ ^
+    start:
+        sanitize = True
+    end:
+        sanitize = True
+
+[rules]
+~ /directive(\[\d+\])?$
+    start:
+        _depth = globals.update (depth=10)
+    end:
+        newfile = True
+
+~ /para(\[\d+\])?$
+    start:
+        depth = depth + 1
+        prefix = "{0}: ".format (depth)
+    end:
+        _name = elem.get ('name', 'para')
+        suffix = " ({0})".format (_name)
+
+~ .*
+    start:
+        sanitize = True
+'''
+
+
+def render (functions):
+    ''' the fragment of a directive holding two paras, with code blocks run
+        as functions where possible or all exec'ed
+    '''
+    rules = RulesParser ()
+    rules.parse (RULES)
+    processor = Transformer (rules)
+    if not functions:
+        for key, (static, func, obj) in processor._blocks.items ():
+            processor._blocks [key] = (static, None, obj)
+    processor.set_srcfile ('test.xml')
+
+    section = etree.SubElement (etree.Element ('module'), 'section')
+    directive = etree.SubElement (section, 'directive', name='d')
+    etree.SubElement (directive, 'para').text = 'one'
+    etree.SubElement (directive, 'para', name='second').text = 'two'
+    fragments = []
+    def collect (processor, options, root, srcfile, element, text):
+        fragments.append (text)
+    convert_element ([processor], option_parser ().get_default_values (), '', 'test.xml', directive, collect)
+    return fragments
+
+
+class FunctionCodeTest (unittest.TestCase):
+    def test_reads_before_assigning (self):
+        for code in 'x = x + 1', 'x += 1', 'y = (lambda: x)\nx = 1':
+            self.assertTrue (reads_before_assigning (ast.parse (code)), code)
+        for code in 'x = 1\ny = x', 'elem = elem.getparent ()', 'a, b = 1, 2\nc = a + b':
+            self.assertFalse (reads_before_assigning (ast.parse (code)), code)
+
+    def test_block_reading_a_global_it_assigns (self):
+        rules = RulesParser ()
+        rules.parse (RULES)
+        self.assertIsNone (rules.block (r'/para(\[\d+\])?$', 'start')[1])
+        self.assertIsNotNone (rules.block (r'/para(\[\d+\])?$', 'end')[1])
+        self.assertEqual (render (True), render (False))
+        self.assertEqual (render (True), ['11: one (para)11: two (second)'])
+
+
+if __name__ == '__main__':
+    unittest.main ()
@@ -0,0 +1,66 @@
+#!/usr/bin/python
+# --------------------------------------------------------------------------
+# test_stream.py
+#
+# doc2.py --stream on a small corpus generated by benchmarks/corpus.py:
+# a source that turns out invalid after some of its root elements were
+# rendered writes no fragments.
+#
+# usage: python -m unittest discover -s tests
+# --------------------------------------------------------------------------
+
+import os, sys
+import shutil
+import subprocess
+import tempfile
+import unittest
+from glob import glob
+
+BASE_DIR = os.path.dirname (os.path.dirname (os.path.abspath (__file__)))
+sys.path.insert (0, os.path.join (BASE_DIR, 'benchmarks'))
+
+from corpus import generate
+
+
+class StreamTest (unittest.TestCase):
+    def setUp (self):
+        self.tmp = tempfile.mkdtemp ()
+        self.src = os.path.join (self.tmp, 'src')
+        self.dest = os.path.join (self.tmp, 'out')
+        self.sources = generate (os.path.join (self.src, 'http'), modules=2, directives=3)
+
+    def tearDown (self):
+        shutil.rmtree (self.tmp)
+
+    def stream (self, *args):
+        with open (os.devnull, 'w') as null:
+            return subprocess.call (
+                [sys.executable, 'doc2.py', '-s', self.src + os.sep, '-d', self.dest, '-f', 'rst', '--stream'] + list (args),
+                cwd=BASE_DIR, stderr=null
+            )
+
+    def fragments (self, source):
+        module = os.path.splitext (os.path.basename (source))[0]
+        return glob (os.path.join (self.dest, 'rst', 'http', module, '*.rst'))
+
+    def test_valid (self):
+        self.assertEqual (self.stream (), 0)
+        for source in self.sources:
+            self.assertEqual (len (self.fragments (source)), 3)
+
+    def test_invalid_source_writes_nothing (self):
+        # the last directive is invalid, the ones before it render fine
+        invalid = self.sources [0]
+        with open (invalid) as f:
+            xml = f.read ()
+        end = xml.rindex ('</directive>')
+        with open (invalid, 'w') as f:
+            f.write (xml [:end] + '<bogus/>' + xml [end:])
+
+        for writers in '0', '2':
+            self.assertNotEqual (self.stream ('--writers', writers), 0)
+            self.assertEqual (self.fragments (invalid), [])
+
+
+if __name__ == '__main__':
+    unittest.main ()
@@ -0,0 +1,93 @@
+#!/usr/bin/python
+# --------------------------------------------------------------------------
+# test_validation.py
+#
+# validation.Validator with cache_dtd and a validation cache, on a DTD that
+# includes its elements and entities from other files.
+#
+# usage: python -m unittest discover -s tests
+# --------------------------------------------------------------------------
+
+import os, sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert (0, os.path.dirname (os.path.dirname (os.path.abspath (__file__))))
+
+from lxml import etree
+from validation import Validator
+
+DTD = '''<!ENTITY % elements SYSTEM "elements.dtd">
+%elements;
+<!ENTITY % entities SYSTEM "entities.ent">
+%entities;
+'''
+
+ELEMENTS = '''<!ELEMENT module (para*)>
+<!ELEMENT para (#PCDATA)>
+'''
+
+ENTITIES = '''<!ENTITY mdash "&#x2014;">
+'''
+
+SOURCE = '''<?xml version="1.0"?>
+<!DOCTYPE module SYSTEM "dtd/module.dtd">
+<module><para>{0}</para></module>
+'''
+
+
+class ValidatorTest (unittest.TestCase):
+    def setUp (self):
+        self.tmp = tempfile.mkdtemp ()
+        os.mkdir (os.path.join (self.tmp, 'dtd'))
+        self.write ('dtd/module.dtd', DTD)
+        self.write ('dtd/elements.dtd', ELEMENTS)
+        self.write ('dtd/entities.ent', ENTITIES)
+        self.plain = self.write ('plain.xml', SOURCE.format ('text'))
+        self.entity = self.write ('entity.xml', SOURCE.format ('a &mdash; b'))
+        self.cache = os.path.join (self.tmp, 'validation.cache')
+
+    def tearDown (self):
+        shutil.rmtree (self.tmp)
+
+    def write (self, name, text):
+        path = os.path.join (self.tmp, name)
+        with open (path, 'w') as f:
+            f.write (text)
+        return path
+
+    def test_same_trees (self):
+        validator = Validator (cache_dtd=True)
+        for path in self.plain, self.entity:
+            expected = etree.parse (path, etree.XMLParser (dtd_validation=True))
+            self.assertEqual (etree.tostring (validator.parse (path)), etree.tostring (expected))
+        self.assertEqual (len (validator.dtds), 1)
+
+    def test_invalid (self):
+        path = self.write ('invalid.xml', SOURCE.format ('<bogus/>'))
+        self.assertRaises (etree.DocumentInvalid, Validator (cache_dtd=True).parse, path)
+
+    def test_cache_skips_unchanged (self):
+        validator = Validator (cache_file=self.cache)
+        validator.parse (self.plain)
+        validator.save ()
+
+        validator = Validator (cache_file=self.cache)
+        validator.parse (self.plain)
+        self.assertEqual (validator.skipped, 1)
+
+    def test_cache_keyed_by_included_files (self):
+        validator = Validator (cache_file=self.cache)
+        validator.parse (self.plain)
+        validator.save ()
+
+        # the source no longer validates once an included file changes
+        self.write ('dtd/elements.dtd', ELEMENTS.replace ('(#PCDATA)', 'EMPTY'))
+        validator = Validator (cache_file=self.cache)
+        self.assertRaises (etree.DocumentInvalid, validator.parse, self.plain)
+        self.assertEqual (validator.skipped, 0)
+
+
+if __name__ == '__main__':
+    unittest.main ()
@@ -0,0 +1,98 @@
+#!/usr/bin/python
+# --------------------------------------------------------------------------
+# test_watch.py
+#
+# doc2.Watcher, as --watch runs it, on a small corpus generated by
+# benchmarks/corpus.py: only the sources that changed since the last poll
+# are converted, and a removed source's fragments go with it.
+#
+# usage: python -m unittest discover -s tests
+# --------------------------------------------------------------------------
+
+import os, sys
+import shutil
+import tempfile
+import unittest
+from glob import glob
+
+BASE_DIR = os.path.dirname (os.path.dirname (os.path.abspath (__file__)))
+sys.path.insert (0, BASE_DIR)
+sys.path.insert (0, os.path.join (BASE_DIR, 'benchmarks'))
+
+from corpus import generate
+import doc2
+
+
+class WatchTest (unittest.TestCase):
+    def setUp (self):
+        self.tmp = tempfile.mkdtemp ()
+        self.src = os.path.join (self.tmp, 'src') + os.sep
+        self.sources = generate (os.path.join (self.src, 'http'), modules=3, directives=2)
+        options = doc2.option_parser ().get_default_values ()
+        options.formats = ['rst']
+        options.rules_dir = doc2.BASE_DIR
+        options.src_dir = self.src
+        options.dest_dir = os.path.join (self.tmp, 'out')
+        doc2.made_dirs.clear ()
+        self.watcher = doc2.Watcher (options, *doc2.load (options))
+
+    def tearDown (self):
+        shutil.rmtree (self.tmp)
+
+    def fragments (self, source):
+        module = os.path.splitext (os.path.basename (source))[0]
+        return sorted (glob (os.path.join (self.tmp, 'out', 'rst', 'http', module, '*.rst')))
+
+    def touch (self, source, xml=None):
+        ''' change a source, and its stamp even within the mtime's resolution
+        '''
+        st = os.stat (source)
+        if xml is not None:
+            with open (source, 'w') as f:
+                f.write (xml)
+        os.utime (source, (st.st_atime, st.st_mtime + 10))
+
+    def test_poll (self):
+        self.assertEqual (len (self.watcher.poll ()), 3)
+        self.assertEqual (self.watcher.conversions, 3)
+        self.assertEqual (self.watcher.poll (), [])
+
+        fragments = dict ((source, self.fragments (source)) for source in self.sources)
+        for paths in fragments.values ():
+            self.assertEqual (len (paths), 2)
+            for path in paths:
+                os.utime (path, (1000, 1000))
+
+        # a changed directive re-renders its source only, and rewrites only
+        # its own fragment
+        changed = self.sources [1]
+        with open (changed) as f:
+            xml = f.read ()
+        end = xml.index ('</para>', xml.index ('<directive'))
+        self.touch (changed, xml [:end] + ' Changed.' + xml [end:])
+
+        self.assertEqual (self.watcher.poll (), [(os.path.dirname (changed), os.path.basename (changed))])
+        self.assertEqual (self.watcher.conversions, 4)
+        mtimes = dict ((path, os.path.getmtime (path)) for paths in fragments.values () for path in paths)
+        self.assertEqual ([path for path, mtime in mtimes.items () if mtime != 1000], fragments [changed][:1])
+
+    def test_removed_source (self):
+        self.watcher.poll ()
+        removed = self.sources [0]
+        self.assertEqual (len (self.fragments (removed)), 2)
+        os.remove (removed)
+        self.assertEqual (self.watcher.poll (), [])
+        self.assertEqual (self.fragments (removed), [])
+        self.assertEqual (len (self.fragments (self.sources [1])), 2)
+
+    def test_render (self):
+        self.watcher.poll ()
+        source = self.sources [2]
+        rendered = dict (self.watcher.render ('rst', filename=os.path.relpath (source, self.src)))
+        for path in self.fragments (source):
+            with open (path) as f:
+                self.assertEqual (rendered [os.path.splitext (os.path.basename (path))[0]], f.read ().decode ('utf-8'))
+
+
+if __name__ == '__main__':
+    unittest.main ()
@@ -0,0 +1,112 @@
+#!/usr/bin/python
+# --------------------------------------------------------------------------
+# test_writer.py
+#
+# store_fragment () and the background Writer when the destination
+# directory disappears between writes, and fragments whose contents didn't
+# change being left alone, by them and by doc2.py rerun on the same sources.
+#
+# usage: python -m unittest discover -s tests
+# --------------------------------------------------------------------------
+
+import os, sys
+import shutil
+import subprocess
+import tempfile
+import unittest
+from glob import glob
+
+BASE_DIR = os.path.dirname (os.path.dirname (os.path.abspath (__file__)))
+sys.path.insert (0, BASE_DIR)
+sys.path.insert (0, os.path.join (BASE_DIR, 'benchmarks'))
+
+from corpus import generate
+import doc2
+from doc2 import Writer, store_fragment
+
+
+class RemovedDirectoryTest (unittest.TestCase):
+    def setUp (self):
+        self.dest = tempfile.mkdtemp ()
+        self.target = os.path.join (self.dest, 'rst', 'module')
+        doc2.made_dirs.clear ()
+
+    def tearDown (self):
+        shutil.rmtree (self.dest, ignore_errors=True)
+
+    def read (self, name):
+        with open (os.path.join (self.target, name)) as f:
+            return f.read ()
+
+    def test_store_fragment (self):
+        store_fragment (self.target, os.path.join (self.target, 'a.rst'), u'one')
+        shutil.rmtree (self.dest)
+        store_fragment (self.target, os.path.join (self.target, 'b.rst'), u'two')
+        self.assertEqual (self.read ('b.rst'), 'two')
+
+    def test_writer (self):
+        writer = Writer (2)
+        writer.put (self.target, os.path.join (self.target, 'a.rst'), u'one')
+        writer.flush ()
+        shutil.rmtree (self.dest)
+        writer.put (self.target, os.path.join (self.target, 'b.rst'), u'two')
+        writer.close ()
+        self.assertEqual (self.read ('b.rst'), 'two')
+
+
+class UnchangedFragmentTest (unittest.TestCase):
+    def setUp (self):
+        self.tmp = tempfile.mkdtemp ()
+        self.target = os.path.join (self.tmp, 'rst', 'module')
+        doc2.made_dirs.clear ()
+
+    def tearDown (self):
+        shutil.rmtree (self.tmp)
+
+    def age (self, paths):
+        ''' backdate files, so a rewrite shows in their mtime
+        '''
+        for path in paths:
+            os.utime (path, (1000, 1000))
+
+    def test_store_fragment (self):
+        path = os.path.join (self.target, 'a.rst')
+        store_fragment (self.target, path, u'one')
+        self.age ([path])
+        unchanged = doc2.fragment_stats ['unchanged']
+        store_fragment (self.target, path, u'one')
+        self.assertEqual (os.path.getmtime (path), 1000)
+        self.assertEqual (doc2.fragment_stats ['unchanged'], unchanged + 1)
+
+        store_fragment (self.target, path, u'two')
+        self.assertNotEqual (os.path.getmtime (path), 1000)
+        with open (path) as f:
+            self.assertEqual (f.read (), 'two')
+
+    def test_rerun (self):
+        src = os.path.join (self.tmp, 'src')
+        sources = generate (os.path.join (src, 'http'), modules=2, directives=3)
+        def run ():
+            subprocess.check_call (
+                [sys.executable, 'doc2.py', '-s', src + os.sep, '-d', os.path.join (self.tmp, 'out'), '-f', 'rst'], cwd=BASE_DIR
+            )
+            return sorted (glob (os.path.join (self.tmp, 'out', 'rst', 'http', '*', '*.rst')))
+
+        fragments = run ()
+        self.assertEqual (len (fragments), 6)
+        self.age (fragments)
+        self.assertEqual (run (), fragments)
+        self.assertEqual ([os.path.getmtime (f) for f in fragments], [1000] * 6)
+
+        # only the fragment of the directive that changed is rewritten
+        with open (sources [0]) as f:
+            xml = f.read ()
+        end = xml.index ('</para>', xml.index ('<directive'))
+        with open (sources [0], 'w') as f:
+            f.write (xml [:end] + ' Changed.' + xml [end:])
+        self.assertEqual (run (), fragments)
+        self.assertEqual (sum (os.path.getmtime (f) != 1000 for f in fragments), 1)
+
+
+if __name__ == '__main__':
+    unittest.main ()
@@ -1,32 +1,199 @@
 #!/usr/bin/python
 
 #
-# Utility to scan local Subversion copy and determine which docs have 
-# been changed and purge the MediaWiki cache for just those pages.  
+# Utility to scan local Subversion copy and determine which docs have
+# been changed and purge the MediaWiki cache for just those pages.
 # Also outputs a list of missing or misnamed pages.
 #
 # Implemenation note: MediaWiki doesn't return 404 for non-existent pages
 # if there's any sort of query string, hence the need for the HEAD request.
 #
+# A state file records a hash of every source and the page it maps to.  Only
+# pages whose source changed since it was last purged successfully are
+# purged; without a state file (the first run) files changed within the
+# cutoff are.
+#
+# Pages are checked and purged by a pool of threads, each keeping its own
+# keep-alive connection to the wiki.  Requests from all threads share a rate
+# limit, and requests that fail are retried on a fresh connection.
+#
 # (c) Cliff Wells, 2012 <cliff@nginx.com>
 #
 
-import os
+from __future__ import print_function
+import os, sys, errno
 import time
+import json
+import socket
+import threading
+import Queue
 from datetime import datetime, timedelta
 import httplib
 from optparse import OptionParser
+from manifest import digest
+
+
+class RateLimit (object):
+    ''' space calls to wait () at least 1/rate seconds apart, across threads
+    '''
+    def __init__ (self, rate=0):
+        self.interval = 1.0 / rate if rate else 0
+        self.lock = threading.Lock ()
+        self.next = 0
+
+    def wait (self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.time ()
+            start = max (now, self.next)
+            self.next = start + self.interval
+        if start > now:
+            time.sleep (start - now)
+
+
+class Purger (object):
+    ''' check and purge wiki pages from a bounded pool of threads
+    '''
+    def __init__ (self, host, concurrency=4, rate=0, retries=2, timeout=30):
+        self.host = host
+        self.concurrency = max (concurrency, 1)
+        self.limit = RateLimit (rate)
+        self.retries = retries
+        self.timeout = timeout
+        self.local = threading.local ()
+        self.lock = threading.Lock ()
+        self.connections = 0
+
+    def connection (self):
+        ''' this thread's connection, opened on first use
+        '''
+        connection = getattr (self.local, 'connection', None)
+        if connection is None:
+            connection = self.local.connection = httplib.HTTPConnection (self.host, timeout=self.timeout)
+            with self.lock:
+                self.connections += 1
+        return connection
+
+    def reset (self):
+        connection = getattr (self.local, 'connection', None)
+        if connection is not None:
+            connection.close ()
+            self.local.connection = None
+
+    def request (self, method, path):
+        ''' make a request, reading the whole response so the connection can
+            be reused.  Connection errors and 5xx responses are retried.
+        '''
+        for attempt in range (self.retries + 1):
+            if attempt:
+                time.sleep (0.5 * 2 ** (attempt - 1))
+            self.limit.wait ()
+            try:
+                connection = self.connection ()
+                connection.request (method, path)
+                response = connection.getresponse ()
+                response.read ()
+            except (socket.error, httplib.HTTPException), e:
+                # also covers a keep-alive connection the server has closed
+                self.reset ()
+                error = "{0} {1}: {2}".format (method, path, str (e) or e.__class__.__name__)
+                continue
+            if response.status < 500:
+                return response.status
+            error = "{0} {1}: {2} {3}".format (method, path, response.status, response.reason)
+        raise IOError (error)
+
+    def purge (self, wikipage):
+        ''' purge a page if it exists, returning PURGED or MISSING
+        '''
+        if self.request ('HEAD', wikipage) != 200:
+            return 'MISSING'
+        self.request ('GET', '{0}?action=purge'.format (wikipage))
+        return 'PURGED'
+
+    def run (self, wikipages, report=None):
+        ''' purge wikipages, calling report (wikipage, result) as each one
+            is done.  Returns {wikipage: result}, FAILED for pages that
+            couldn't be checked or purged.
+        '''
+        pages = Queue.Queue ()
+        for wikipage in wikipages:
+            pages.put (wikipage)
+        results = {}
+
+        def worker ():
+            try:
+                while True:
+                    try:
+                        wikipage = pages.get_nowait ()
+                    except Queue.Empty:
+                        return
+                    try:
+                        result = self.purge (wikipage)
+                    except IOError, e:
+                        print (e, file=sys.stderr)
+                        result = 'FAILED'
+                    except Exception, e:
+                        # anything unexpected fails this page only, the
+                        # thread goes on with the others
+                        print ("{0}: {1}: {2}".format (wikipage, e.__class__.__name__, e), file=sys.stderr)
+                        self.reset ()
+                        result = 'FAILED'
+                    with self.lock:
+                        results [wikipage] = result
+                        if report:
+                            report (wikipage, result)
+            finally:
+                self.reset ()
+
+        threads = [threading.Thread (target=worker) for n in range (min (self.concurrency, len (wikipages)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start ()
+        for thread in threads:
+            while thread.is_alive ():
+                thread.join (1)     # a plain join () can't be interrupted
+        return results
+
 
 parser = OptionParser ()
-parser.set_defaults (cutoff=30, all=False)
-parser.add_option ("-c", "--cutoff", dest="cutoff", help="only process files newer than N minutes", metavar="MINUTES", type=int)
+parser.set_defaults (cutoff=30, all=False, host='wiki.nginx.org', concurrency=4, rate=0, retries=2, state='.update_pages.state')
+parser.add_option ("-s", "--state", dest="state", help="hashes of the sources as last purged [.update_pages.state]", metavar="FILE")
+parser.add_option ("-c", "--cutoff", dest="cutoff", help="without a state file, only process files newer than N minutes", metavar="MINUTES", type=int)
 parser.add_option ("-a", "--all", action="store_true", dest="all", help="process all files", metavar="")
+parser.add_option ("-H", "--host", dest="host", help="wiki to purge [wiki.nginx.org]", metavar="HOST[:PORT]")
+parser.add_option ("-n", "--concurrency", dest="concurrency", help="pages to check and purge at once [4]", metavar="N", type=int)
+parser.add_option ("-r", "--rate", dest="rate", help="at most N requests per second, 0 for no limit [0]", metavar="N", type=float)
+parser.add_option ("--retries", dest="retries", help="retry failed requests N times [2]", metavar="N", type=int)
 (options, args) = parser.parse_args ()
 
+def load_state (filename):
+    ''' {source: {hash: ..., wikipage: ...}}, or None if there is no state
+    '''
+    try:
+        with open (filename) as f:
+            return json.load (f)
+    except IOError, e:
+        if e.errno != errno.ENOENT:
+            raise
+    except ValueError:
+        print ("Ignoring corrupt state file {0}".format (filename), file=sys.stderr)
+    return None
+
+def save_state (filename, state):
+    tmp = filename + '.tmp'
+    with open (tmp, 'w') as f:
+        json.dump (state, f, indent=1, sort_keys=True)
+    os.rename (tmp, filename)
+
+previous = load_state (options.state)
+
 # assume that SVN is updated less than 30 minutes prior to now
 cutoff = datetime.now () - timedelta (minutes=options.cutoff)
 
-changes = []
+state = {}
+changes = {}        # source -> hash, of the changed sources
 for root, folders, files in os.walk ('nginx.org/xml/en/docs/http/'):
     for filename in files:
 
@@ -34,22 +201,47 @@ for root, folders, files in os.walk ('nginx.org/xml/en/docs/http/'):
         basename, ext = os.path.splitext (filename)
         if ext != '.xml': continue
 
-        # only files changed within last <cutoff> minutes
-        st = os.stat (os.path.join (root, filename))    
-        mtime = datetime.fromtimestamp (st.st_mtime)
-        if mtime < cutoff and not options.all:
-            continue
-
-        # convert filename to wiki page style
-        wikipage = '/' + ''.join ([part.capitalize () for part in basename.split ('_')[1:]])
-
-        connection = httplib.HTTPConnection ('wiki.nginx.org')
-        connection.request ('HEAD', wikipage)
-        if connection.getresponse().status == 200:
-            # purge the wm cache
-            connection.request ('GET', '{0}?action=purge'.format (wikipage))
-            print ("PURGED: {0}".format (wikipage))
+        source = os.path.join (root, filename)
+        entry = (previous or {}).get (source)
+        hash = digest (source)
+        if entry is None:
+            # convert filename to wiki page style
+            wikipage = '/' + ''.join ([part.capitalize () for part in basename.split ('_')[1:]])
+            entry = dict (hash=None, wikipage=wikipage)
+        state [source] = entry
+
+        if options.all:
+            pass
+        elif previous is not None:
+            # only files whose contents changed since they were last purged
+            if entry ['hash'] == hash:
+                continue
         else:
-            # page missing
-            print ("MISSING: {0}".format (wikipage))
-        connection.close ()
+            # only files changed within last <cutoff> minutes
+            st = os.stat (source)
+            mtime = datetime.fromtimestamp (st.st_mtime)
+            if mtime < cutoff:
+                entry ['hash'] = hash
+                continue
+
+        changes [source] = hash
+
+def report (wikipage, result):
+    print ("{0}: {1}".format (result, wikipage))
+
+# several sources may map to one page, which is purged once
+purger = Purger (options.host, options.concurrency, options.rate, options.retries)
+results = purger.run (sorted (set (state [source]['wikipage'] for source in changes)), report)
+
+# sources whose page failed keep their old hash, so they are retried next time
+for source, hash in changes.items ():
+    if results [state [source]['wikipage']] != 'FAILED':
+        state [source]['hash'] = hash
+save_state (options.state, state)
+
+results = results.values ()
+print ("{0} PURGED, {1} MISSING, {2} FAILED over {3} connections".format (
+    results.count ('PURGED'), results.count ('MISSING'), results.count ('FAILED'), purger.connections
+))
+if 'FAILED' in results:
+    sys.exit (1)
@@ -0,0 +1,195 @@
+# --------------------------------------------------------------------------
+# validation.py
+#
+# Parsing and DTD validation of XML sources for doc2.py.
+#
+# By default sources are parsed with a validating parser, which loads and
+# validates against the DTD a document references every time.  With
+# cache_dtd, each distinct DTD is loaded once into an etree.DTD, sources are
+# parsed without loading their DTD and the trees are validated against it.
+# A validation cache file additionally records the sources that validated,
+# keyed by the source and the files of its DTD, so unchanged ones aren't
+# validated again.
+# --------------------------------------------------------------------------
+
+import os, errno
+import re
+import time
+import json
+import hashlib
+from lxml import etree
+from manifest import digest
+
+# a parameter or general entity declaration referencing another file
+EXTERNAL_ENTITY = re.compile (r'''<!ENTITY\s+(?:%\s+)?[^\s]+\s+(?:SYSTEM|PUBLIC\s+(?:"[^"]*"|'[^']*'))\s+(?:"([^"]*)"|'([^']*)')''')
+
+def is_url (path):
+    return re.match (r'^[a-zA-Z][\w+.-]*:', path) is not None
+
+
+class DTDResolver (etree.Resolver):
+    ''' serve the files of the DTDs a Validator loaded from memory
+    '''
+    def __init__ (self, texts):
+        super (DTDResolver, self).__init__ ()
+        self.texts = texts
+
+    def resolve (self, url, pubid, context):
+        if url and not is_url (url):
+            text = self.texts.get (os.path.normpath (url))
+            if text is not None:
+                return self.resolve_string (text, context, base_url=url)
+        return None
+
+
+class Validator (object):
+    def __init__ (self, cache_dtd=False, cache_file=None):
+        self.cache_dtd = cache_dtd or bool (cache_file)
+        self.cache_file = cache_file
+        self.dtds = {}               # DTD path -> (etree.DTD, digest)
+        self.texts = {}              # DTD path or file it includes -> contents
+        self.validated = {}          # source -> key it last validated with
+        self.parse_time = 0.0        # includes validation unless cache_dtd
+        self.validate_time = 0.0
+        self.skipped = 0
+        self._recent = {}            # validated since the last drain ()
+
+        if self.cache_dtd:
+            # sources are parsed without their DTD, leaving entity references
+            # in place.  self.parser loads the DTD from memory so entities
+            # resolve exactly as they do when validating, for strings and
+            # for the sources that reference entities.
+            self.lean_parser = etree.XMLParser (load_dtd=False, resolve_entities=False)
+            self.parser = etree.XMLParser (load_dtd=True)
+            self.parser.resolvers.add (DTDResolver (self.texts))
+        else:
+            self.parser = etree.XMLParser (dtd_validation=True)
+
+        if cache_file:
+            try:
+                with open (cache_file) as f:
+                    self.validated = json.load (f)
+            except IOError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+            except ValueError:
+                pass
+
+    def parse (self, filename):
+        start = time.time ()
+        if self.cache_dtd:
+            tree = etree.parse (filename, self.lean_parser)
+            if self.needs_dtd (filename, tree):
+                tree = etree.parse (filename, self.parser)
+        else:
+            tree = etree.parse (filename, self.parser)
+        self.parse_time += time.time () - start
+
+        if self.cache_dtd:
+            start = time.time ()
+            self.validate (filename, tree)
+            self.validate_time += time.time () - start
+        return tree
+
+    def iterparse (self, filename, **kw):
+        ''' iterparse a source, validating as it is read.  Time spent in
+            the parser is added to parse_time.
+        '''
+        context = iter (etree.iterparse (filename, dtd_validation=True, **kw))
+        while True:
+            start = time.time ()
+            try:
+                item = next (context)
+            except StopIteration:
+                return
+            finally:
+                self.parse_time += time.time () - start
+            yield item
+
+    def needs_dtd (self, filename, tree):
+        ''' whether a tree parsed without its DTD differs from one parsed
+            with it, as it holds entity references.  Loads the DTD for the
+            resolver.
+        '''
+        if not tree.docinfo.system_url or next (tree.iter (etree.Entity), None) is None:
+            return False
+        self.dtd (filename, tree)
+        return True
+
+    def dtd_path (self, filename, tree):
+        url = tree.docinfo.system_url
+        if not url:
+            raise etree.DocumentInvalid ("no DTD found!")
+        if is_url (url):
+            return url
+        return os.path.normpath (os.path.join (os.path.dirname (filename), url))
+
+    def dtd (self, filename, tree):
+        ''' the etree.DTD a tree references, and a digest of the DTD's file
+            and the files it includes (a URL stands for itself)
+        '''
+        path = self.dtd_path (filename, tree)
+        if path not in self.dtds:
+            if is_url (path) or not os.path.exists (path):
+                dtd_digest = path
+            else:
+                h = hashlib.sha1 ()
+                for name in self.read (path):
+                    h.update ('{0}\0{1}\0'.format (name, hashlib.sha1 (self.texts [name]).hexdigest ()))
+                dtd_digest = h.hexdigest ()
+            self.dtds [path] = (etree.DTD (path), dtd_digest)
+        return self.dtds [path]
+
+    def read (self, path, files=None):
+        ''' read a DTD and the local files its entities reference into
+            texts, returning their paths
+        '''
+        files = files if files is not None else []
+        if path in files or is_url (path) or not os.path.exists (path):
+            return files
+        with open (path, 'rb') as f:
+            self.texts [path] = f.read ()
+        files.append (path)
+        for match in EXTERNAL_ENTITY.finditer (self.texts [path]):
+            url = match.group (1) if match.group (1) is not None else match.group (2)
+            if not is_url (url):
+                self.read (os.path.normpath (os.path.join (os.path.dirname (path), url)), files)
+        return files
+
+    def validate (self, filename, tree):
+        dtd, dtd_digest = self.dtd (filename, tree)
+        key = None
+        if self.cache_file:
+            key = '{0}:{1}'.format (digest (filename), dtd_digest)
+            if self.validated.get (filename) == key:
+                self.skipped += 1
+                return
+
+        dtd.assertValid (tree)
+        if key:
+            self.validated [filename] = self._recent [filename] = key
+
+    def drain (self):
+        ''' return and reset what this Validator did since the last call,
+            for merge () into another Validator
+        '''
+        stats = (self.parse_time, self.validate_time, self.skipped, self._recent)
+        self.parse_time = self.validate_time = 0.0
+        self.skipped = 0
+        self._recent = {}
+        return stats
+
+    def merge (self, stats):
+        parse_time, validate_time, skipped, validated = stats
+        self.parse_time += parse_time
+        self.validate_time += validate_time
+        self.skipped += skipped
+        self.validated.update (validated)
+
+    def save (self):
+        if not self.cache_file:
+            return
+        tmp = self.cache_file + '.tmp'
+        with open (tmp, 'w') as f:
+            json.dump (self.validated, f, indent=1, sort_keys=True)
+        os.rename (tmp, self.cache_file)